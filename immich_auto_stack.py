@@ -1,18 +1,51 @@
 #!/usr/bin/env python3
 
 import logging, sys
-from itertools import groupby
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import compress, count, groupby
+import bisect
+import heapq
 import json
+import mmap
 import os
+import queue
 import re
+import struct
+import tempfile
+import threading
 import time
+import zlib
 
 from str2bool import str2bool
-from requests import Session
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 from urllib.parse import urlparse
 
+# requests and urllib3 are imported by load_http() on first use. They make up
+# most of the startup time, and a tick that is locked out or finds nothing
+# changed never needs them. concurrent.futures, logging.handlers and pickle
+# are likewise imported where they are used.
+_http_names = ('RequestException', 'Session', 'HTTPAdapter', 'Retry')
+
+def load_http() -> None:
+  global RequestException, Session, HTTPAdapter, Retry
+  if all(name in globals() for name in _http_names):
+    return
+  from requests import RequestException, Session
+  from requests.adapters import HTTPAdapter
+  from urllib3.util.retry import Retry
+
+def __getattr__(name: str):
+  if name in _http_names:
+    load_http()
+    return globals()[name]
+  raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+try:
+  import fcntl
+except ImportError:
+  # Not available on Windows, RunLock falls back to an exclusive lockfile
+  fcntl = None
+
 logging.basicConfig(
   stream=sys.stdout, 
   level=logging.INFO, 
@@ -20,6 +53,91 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Per-stack detail. Logged at DEBUG in LOG_SUMMARY mode and copied to REPORT_FILE
+detail_logger = logging.getLogger(f'{__name__}.detail')
+detail_level = logging.INFO
+
+@contextmanager
+def queued_logging():
+  """
+  Route all log records through a queue drained by a background thread, so
+  that slow writes to stdout do not block the stacking loop.
+
+  Honors LOG_LEVEL, LOG_SUMMARY and REPORT_FILE. Pending records are flushed
+  and the previous handlers restored on exit.
+  """
+  global detail_level
+  from logging.handlers import QueueHandler, QueueListener
+
+  level = logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO").upper())
+  summary = str2bool(os.environ.get("LOG_SUMMARY", False))
+  report_file = os.environ.get("REPORT_FILE")
+  formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+  stream_handler = logging.StreamHandler(sys.stdout)
+  stream_handler.setLevel(level)
+  stream_handler.setFormatter(formatter)
+  handlers = [stream_handler]
+
+  detail_level = logging.DEBUG if summary else logging.INFO
+
+  if report_file:
+    report_handler = logging.FileHandler(report_file)
+    report_handler.setFormatter(formatter)
+    report_handler.addFilter(lambda record: record.name == detail_logger.name)
+    handlers.append(report_handler)
+    detail_logger.setLevel(logging.DEBUG)
+
+  root = logging.getLogger()
+  previous_handlers, previous_level = root.handlers[:], root.level
+  log_queue = queue.SimpleQueue()
+  listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+
+  root.handlers = [QueueHandler(log_queue)]
+  root.setLevel(level)
+  listener.start()
+  try:
+    yield
+  finally:
+    listener.stop()
+    for handler in handlers:
+      handler.close()
+    root.handlers = previous_handlers
+    root.setLevel(previous_level)
+    detail_logger.setLevel(logging.NOTSET)
+    detail_level = logging.INFO
+
+def log_detail(message: str) -> None:
+  detail_logger.log(detail_level, message)
+
+class Progress():
+  """
+  Aggregated progress for LOG_SUMMARY mode: logs rate and ETA at most once
+  per `interval` seconds instead of a line per item.
+  """
+  def __init__(self, total: int, label: str = 'stacks', interval: float = 10.0):
+    self.total = total
+    self.label = label
+    self.interval = interval
+    self.done = 0
+    self.start = self.last = time.monotonic()
+
+  def step(self, count: int = 1) -> None:
+    self.done += count
+    now = time.monotonic()
+    if now - self.last >= self.interval or self.done >= self.total:
+      self.last = now
+      self.report(now)
+
+  def report(self, now: float) -> None:
+    elapsed = max(now - self.start, 1e-9)
+    rate = self.done / elapsed
+    eta = (self.total - self.done) / rate if rate else 0
+    logger.info(
+      f'⏱️  {self.done}/{self.total} {self.label} | '
+      f'{rate:.1f} {self.label}/s | ETA {eta:.0f}s'
+    )
+
 criteria_default = [
   {
     "key": "originalFileName",
@@ -33,15 +151,260 @@ criteria_default = [
   }
 ]
 
-def get_criteria_config():
+def get_criteria_sets() -> list:
+    """
+    CRITERIA is either a list of rules, or an object of named rule sets that
+    are evaluated in order over the same assets. Returns [(name, rules)].
+    """
     criteria_override = os.environ.get("CRITERIA")
     if criteria_override:
-        return json.loads(criteria_override)
-    return criteria_default
+        criteria = json.loads(criteria_override)
+        if isinstance(criteria, dict):
+            return list(criteria.items())
+        return [("default", criteria)]
+    return [("default", criteria_default)]
+
+def get_criteria_config():
+    # With several rule sets, the first one has precedence
+    return get_criteria_sets()[0][1]
+
+def get_exif_criteria_config() -> list:
+    exif_criteria = os.environ.get("EXIF_CRITERIA")
+    if exif_criteria:
+        return json.loads(exif_criteria)
+    return []
+
+class RegexTimeout(Exception):
+  pass
+
+class SafePattern():
+  """
+  A CRITERIA regex for REGEX_SAFE mode, where one pathological pattern must
+  not stall the run.
+
+  Uses the linear-time re2 engine when it is installed and supports the
+  pattern (it rejects backreferences and lookarounds). Otherwise every match
+  gets a budget of `timeout` seconds, from the regex module's own timeout
+  when installed, else from a SIGALRM timer around the standard re engine.
+  Exceeding it raises RegexTimeout.
+  """
+  def __init__(self, pattern: str, timeout: float = 0.5):
+    self.pattern = pattern
+    self.timeout = timeout
+    # Raises re.error for invalid patterns, whatever the engine
+    self.compiled = re.compile(pattern)
+    self.engine = 're'
+    try:
+      import re2
+      options = re2.Options()
+      options.log_errors = False
+      self.compiled = re2.compile(pattern, options)
+      self.engine = 're2'
+      return
+    except ImportError:
+      pass
+    except Exception:
+      # Valid for re but beyond what re2 supports
+      pass
+    try:
+      import regex
+      self.compiled = regex.compile(pattern)
+      self.engine = 'regex'
+    except ImportError:
+      pass
+
+  def match(self, value: str):
+    if self.engine == 're2':
+      return self.compiled.match(value)
+    if self.engine == 'regex':
+      try:
+        return self.compiled.match(value, timeout=self.timeout)
+      except TimeoutError:
+        raise RegexTimeout(self.pattern)
+    return self._matchWithAlarm(value)
+
+  def _matchWithAlarm(self, value: str):
+    import signal
+    if not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+      return self.compiled.match(value)
+
+    def expire(signum, frame):
+      raise RegexTimeout(self.pattern)
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, self.timeout)
+    try:
+      return self.compiled.match(value)
+    finally:
+      signal.setitimer(signal.ITIMER_REAL, 0)
+      signal.signal(signal.SIGALRM, previous)
+
+# A quantified group holding a quantifier itself, e.g. (a+)+ or (\w+_?)*
+nested_quantifier = re.compile(r'\((?:[^()\\]|\\.)*[+*}](?:[^()\\]|\\.)*\)[+*{]')
+
+safe_patterns = {}
+regex_timeouts = []
+
+def get_safe_pattern(pattern: str) -> SafePattern:
+  timeout = float(os.environ.get("REGEX_TIMEOUT", 0.5))
+  key = (pattern, timeout)
+  if key not in safe_patterns:
+    safe_patterns[key] = SafePattern(pattern, timeout)
+  return safe_patterns[key]
+
+def criteria_regexes(criteria_sets: list) -> list:
+  return [
+    item["regex"]["key"]
+    for _, rules in criteria_sets
+    for item in rules
+    if "regex" in item
+  ]
+
+def validate_criteria_regexes(criteria_sets: list) -> bool:
+  """
+  Compile every CRITERIA regex up front, so that a typo fails the run before
+  the fetch rather than on the first asset. In REGEX_SAFE mode, also log the
+  engine each pattern runs on and warn about nested quantifiers, the usual
+  cause of catastrophic backtracking.
+  """
+  safe = str2bool(os.environ.get("REGEX_SAFE", False))
+  valid = True
+  for pattern in criteria_regexes(criteria_sets):
+    try:
+      compiled = get_safe_pattern(pattern) if safe else re.compile(pattern)
+    except re.error as e:
+      logger.error(f'⛔  Invalid CRITERIA regex {pattern}: {e}')
+      valid = False
+      continue
+    if not safe:
+      continue
+    if compiled.engine == 're2':
+      logger.info(f'🛡️  Regex {pattern} runs on the linear-time re2 engine')
+      continue
+    logger.info(f'🛡️  Regex {pattern} runs on {compiled.engine} with a {compiled.timeout}s budget per match')
+    if nested_quantifier.search(pattern):
+      logger.warning(f'⚠️  Regex {pattern} has a nested quantifier and may backtrack heavily on some filenames')
+  return valid
+
+def match_criteria_regex(pattern: str, value: str):
+  if str2bool(os.environ.get("REGEX_SAFE", False)):
+    return get_safe_pattern(pattern).match(value)
+  return re.match(pattern, value)
+
+def report_regex_timeouts() -> None:
+  if not regex_timeouts:
+    return
+  logger.warning(f'⏱️  {len(regex_timeouts)} assets were skipped because a regex ran out of time:')
+  for asset_id, value, pattern in regex_timeouts:
+    logger.warning(f'   {asset_id} {value} regex: {pattern}')
+
+# Characters that may follow a base name in the name of a derivative
+prefix_boundary_default = "-_ .~("
+
+# Values of "prefix" rules computed by resolvePrefixes: (rule, asset id) -> root
+prefix_roots = {}
+
+def base_name(filename: str) -> str:
+  # Normalized for prefix matching: extension dropped, case-insensitive
+  return filename.rsplit('.', 1)[0].upper()
+
+def prefix_rule_id(item: dict) -> str:
+  return json.dumps(item, sort_keys=True)
+
+def uses_prefix(config: list) -> bool:
+  return any("prefix" in item for item in config)
+
+def prefix_candidates(name: str, boundary: str):
+  # Every prefix of name that ends just before a boundary character,
+  # shortest first, then the name itself
+  for i in range(1, len(name)):
+    if name[i] in boundary:
+      yield name[:i]
+  yield name
 
-def apply_criteria(x: dict) -> list:
+def resolvePrefixes(data: list, config: list) -> None:
+  """
+  Compute the value of every "prefix" rule in config for the assets in data.
+
+  Assets are bucketed by the other rules of config. Within a bucket each
+  asset resolves to the shortest base name of the bucket that is a prefix of
+  its own base name and ends at a boundary character. IMG_1234-edit.jpg and
+  IMG_1234_HDR.tif thus join IMG_1234.CR2, but IMG_12345.jpg does not. The
+  base names of a bucket are indexed in a set and each asset probes it once
+  per boundary in its name, so the cost grows linearly with the library
+  instead of comparing every pair of names.
+
+  With a "window" in seconds, a base name only counts when one of its assets
+  lies within the window of the derivative's localDateTime. Assets sharing a
+  base name are split into sessions at gaps longer than the window, so that
+  a camera counter that wrapped around does not merge unrelated shots.
+  """
+  others = [item for item in config if "prefix" not in item]
+
+  for item in config:
+    if "prefix" not in item:
+      continue
+    rule = prefix_rule_id(item)
+    options = item["prefix"] if isinstance(item["prefix"], dict) else {}
+    boundary = options.get("boundary", prefix_boundary_default)
+    window = options.get("window")
+
+    entries = []
+    index = {}
+    for x in data:
+      value = x.get(item["key"])
+      if value is None:
+        continue
+      bucket = tuple(apply_criteria(x, others)) if others else ()
+      if others and not bucket:
+        continue
+      name = base_name(value)
+      taken = as_datetime(x.get("localDateTime")) if window is not None else None
+      if window is not None and taken is None:
+        continue
+      entries.append((x.get("id"), bucket, name, taken))
+      index.setdefault(bucket, {}).setdefault(name, []).append(taken)
+
+    if window is not None:
+      # Replace the times of each base name by its sessions: the start times,
+      # for bisection, and [start, end, key] of each session
+      limit = timedelta(seconds=window)
+      for names in index.values():
+        for name, times in names.items():
+          sessions = []
+          for taken in sorted(times):
+            if sessions and taken - sessions[-1][1] <= limit:
+              sessions[-1][1] = taken
+            else:
+              sessions.append([taken, taken, f'{name} {taken.isoformat()}'])
+          names[name] = ([session[0] for session in sessions], sessions)
+
+    for asset_id, bucket, name, taken in entries:
+      names = index[bucket]
+      for candidate in prefix_candidates(name, boundary):
+        if candidate not in names:
+          continue
+        if window is None:
+          prefix_roots[(rule, asset_id)] = candidate
+          break
+        starts, sessions = names[candidate]
+        # Sessions are further apart than the window, so only the last two
+        # starting before taken + window can be in reach
+        i = bisect.bisect_right(starts, taken + limit) - 1
+        session = next((sessions[j] for j in (i, i - 1) if j >= 0 and sessions[j][1] + limit >= taken), None)
+        if session is not None:
+          prefix_roots[(rule, asset_id)] = session[2]
+          break
+
+def as_datetime(value) -> datetime:
+  if value is None or isinstance(value, datetime):
+    return value
+  return parse_datetime(value)
+
+def apply_criteria(x: dict, config: list = None) -> list:
     """
-    Given a photo dataset, pick out the identified keys as defined by CRITERIA.
+    Given a photo dataset, pick out the identified keys as defined by CRITERIA,
+    or by `config` when given.
 
     Keys can be raw values or a subset of values (using split or regex modifiers).
 
@@ -49,7 +412,7 @@ def apply_criteria(x: dict) -> list:
     an empty list.
     """
     criteria_list = []
-    for item in get_criteria_config():
+    for item in config or get_criteria_config():
         value = x.get(item["key"])
         if value is None:
             # None is a undesireable key value for this project because we rely on keys
@@ -60,6 +423,11 @@ def apply_criteria(x: dict) -> list:
             # thumbnails. It would be undesireable to create a stack of all the photos
             # whose thumbhash is None.
             return []
+        if "prefix" in item.keys():
+            # Resolved over the whole library by resolvePrefixes beforehand
+            value = prefix_roots.get((prefix_rule_id(item), x.get("id")), base_name(value))
+            criteria_list.append(value)
+            continue
         if "split" in item.keys():
             split_key = item["split"]["key"]
             split_index = item["split"]["index"]
@@ -68,7 +436,12 @@ def apply_criteria(x: dict) -> list:
             regex_key = item["regex"]["key"]
             # expects at least one regex group to be defined
             regex_index = item["regex"].get("index", 1)
-            match = re.match(regex_key, value)
+            try:
+              match = match_criteria_regex(regex_key, value)
+            except RegexTimeout:
+              # Reported at the end of the run, the asset is left out like a miss
+              regex_timeouts.append((x.get("id"), value, regex_key))
+              return []
             if match:
               value = match.group(regex_index)
             elif not str2bool(os.environ.get("SKIP_MATCH_MISS")):
@@ -91,84 +464,862 @@ def parent_criteria(x):
 
   for key in parent_promote:
     if key.lower() in lower_filename:
-      logger.info("promoting " + x["originalFileName"] + f" for key {key}")
+      log_detail("promoting " + x["originalFileName"] + f" for key {key}")
       parent_promote_baseline -= 1
 
+  parent_exif_prefer = os.environ.get("PARENT_EXIF_PREFER")
+  if parent_exif_prefer:
+    # Largest value first, e.g. the full resolution version by exifImageWidth
+    exif_value = (x.get("exifInfo") or {}).get(parent_exif_prefer) or 0
+    return [parent_promote_baseline, -exif_value, x["originalFileName"]]
+
   return [parent_promote_baseline, x["originalFileName"]]
 
 
+# Immich rejects /search/metadata and /search/random requests above this size
+server_page_limit = 1000
+
+class PageSizer():
+  """
+  Chooses the /search/metadata page size. When adaptive, the size doubles
+  after fast pages and halves after slow or heavy ones, within bounds. Both
+  the size and the bounds are capped at server_page_limit.
+
+  The API pages by number, so a size only changes when the current offset
+  is a multiple of the new size. Sizes stay `start * 2**k`, which keeps
+  halving always possible and doubling possible every other page.
+  """
+  def __init__(self, size: int, adaptive: bool = False, minimum: int = 250, maximum: int = server_page_limit,
+               target_seconds: float = 2.0, max_bytes: int = 50 * 1024 * 1024):
+    if size > server_page_limit:
+      logger.warning(f'⚠️  PAGE_SIZE {size} is above the server limit, using {server_page_limit}')
+      size = server_page_limit
+    self.size = size
+    self.adaptive = adaptive
+    self.minimum = minimum
+    self.maximum = min(maximum, server_page_limit)
+    self.target_seconds = target_seconds
+    self.max_bytes = max_bytes
+    self.metrics = {
+      "page_size_start": size,
+      "page_size_final": size,
+      "page_size_min": size,
+      "page_size_max": size,
+      "pages": 0,
+      "fetch_seconds": 0.0,
+      "fetch_bytes": 0,
+    }
+
+  @classmethod
+  def fromEnvironment(cls, size: int) -> 'PageSizer':
+    return cls(
+      size,
+      adaptive=str2bool(os.environ.get("PAGE_SIZE_ADAPTIVE", False)),
+      minimum=int(os.environ.get("PAGE_SIZE_MIN", 250)),
+      maximum=int(os.environ.get("PAGE_SIZE_MAX", server_page_limit)),
+      target_seconds=float(os.environ.get("PAGE_TARGET_SECONDS", 2)),
+      max_bytes=int(float(os.environ.get("PAGE_MAX_MB", 50)) * 1024 * 1024),
+    )
+
+  def observe(self, seconds: float, page_bytes: int, next_offset: int) -> None:
+    self.metrics["pages"] += 1
+    self.metrics["fetch_seconds"] += seconds
+    self.metrics["fetch_bytes"] += page_bytes
+
+    if self.adaptive:
+      slow = seconds > self.target_seconds or page_bytes > self.max_bytes
+      fast = seconds < self.target_seconds / 2 and page_bytes * 2 <= self.max_bytes
+      if slow and self.size % 2 == 0 and self.size // 2 >= self.minimum:
+        self.size //= 2
+      elif fast and self.size * 2 <= self.maximum and next_offset % (self.size * 2) == 0:
+        self.size *= 2
+
+    self.metrics["page_size_final"] = self.size
+    self.metrics["page_size_min"] = min(self.metrics["page_size_min"], self.size)
+    self.metrics["page_size_max"] = max(self.metrics["page_size_max"], self.size)
+
+
+def log_fetch_metrics(metrics: dict) -> None:
+  if not metrics or not metrics["pages"]:
+    return
+  logger.info(
+    f'📈  Page size: {metrics["page_size_start"]} → {metrics["page_size_final"]} '
+    f'(range {metrics["page_size_min"]}-{metrics["page_size_max"]}) | '
+    f'{metrics["fetch_seconds"] / metrics["pages"]:.2f}s and '
+    f'{metrics["fetch_bytes"] / metrics["pages"] / 1024:.0f} KiB per page'
+  )
+
+
+class IncompleteFetchError(Exception):
+  """
+  A page could not be fetched after all retries, so only part of the
+  library is known.
+  """
+  def __init__(self, page: int, pages_fetched: int, reason: str):
+    super().__init__(
+      f"Page {page} failed after retries ({reason}); only {pages_fetched} pages were fetched"
+    )
+    self.page = page
+    self.pages_fetched = pages_fetched
+
+
+def api_root(url: str) -> str:
+  return f'{urlparse(url).scheme}://{urlparse(url).netloc}/api'
+
 class Immich():
   def __init__(self, url: str, key: str):
-    self.api_url = f'{urlparse(url).scheme}://{urlparse(url).netloc}/api'
+    load_http()
+    self.api_url = api_root(url)
     self.headers = {
       'x-api-key': key,
       'Accept': 'application/json'
     }
     self.assets = list()
+    self.pool_size = 10
+    self.session = None
+    self.metrics = {}
+
+  def getSession(self) -> 'Session':
+    """
+    One Session, and so one connection pool, shared by the fetch and every
+    mutation thread.
+    """
+    if self.session is None:
+      self.session = Session()
+      self._mountAdapter()
+    return self.session
+
+  def _mountAdapter(self) -> None:
+    retry = Retry(connect=3, backoff_factor=0.5)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=self.pool_size)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  def ensurePoolSize(self, size: int) -> None:
+    """
+    Grow the connection pool to at least `size` connections. A session that
+    exists already gets a new adapter, since the pool size is fixed when the
+    adapter is created.
+    """
+    if size <= self.pool_size:
+      return
+    self.pool_size = size
+    if self.session is not None:
+      self._mountAdapter()
   
-  def fetchAssets(self, size: int = 1000) -> list:
+  def _fetchPage(self, session: 'Session', payload: dict, retries: int, backoff: float, pages_fetched: int,
+                 endpoint: str = '/search/metadata') -> tuple:
+    """
+    POST one /search/metadata page, retrying server errors, throttling and
+    connection failures with exponential backoff. Returns the decoded page
+    and its size in bytes.
+    """
+    reason = None
+    for attempt in range(retries + 1):
+      if attempt:
+        delay = backoff * 2 ** (attempt - 1)
+        logger.warning(f'   Page {payload.get("page", 1)} failed ({reason}), retry {attempt}/{retries} in {delay:.1f}s')
+        time.sleep(delay)
+      try:
+        response = session.post(f"{self.api_url}{endpoint}", headers=self.headers, json=payload)
+      except RequestException as e:
+        reason = type(e).__name__
+        continue
+
+      if response.ok:
+        try:
+          return response.json(), len(response.content)
+        except ValueError:
+          reason = 'invalid JSON'
+          continue
+
+      reason = f'{response.status_code} {response.text[:200]}'
+      logger.error(f'   Error: {reason}')
+      if response.status_code < 500 and response.status_code != 429:
+        break
+
+    raise IncompleteFetchError(payload.get("page", 1), pages_fetched, reason)
+
+  def _readCheckpoint(self, path: str, header: dict, max_age: float) -> tuple:
+    """
+    Return the pages saved by an interrupted run with the offset and page
+    size to resume from, or ([], 0, None) when there is no usable checkpoint.
+    """
+    try:
+      if time.time() - os.path.getmtime(path) > max_age:
+        return [], 0, None
+      with open(path) as f:
+        lines = f.read().splitlines()
+      if not lines or json.loads(lines[0]) != header:
+        return [], 0, None
+    except (OSError, ValueError):
+      return [], 0, None
+
+    pages = []
+    offset = 0
+    size = None
+    for line in lines[1:]:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        # Interrupted while writing the last page
+        break
+      pages.append(record["items"])
+      offset = record["next"]
+      size = record["size"]
+    return pages, offset, size
+
+  def iterPages(self, size: int = 1000, order: str = None):
+    """
+    Yield the assets of /search/metadata one page at a time. `order` ("asc" or
+    "desc") sorts the pages by fileCreatedAt.
+
+    Each page is retried FETCH_RETRIES times with backoff before giving up
+    with IncompleteFetchError. With FETCH_CHECKPOINT, fetched pages are
+    appended to that file so a later run resumes from the failed page. With
+    PAGE_SIZE_ADAPTIVE, the page size follows the observed latency.
+    """
     payload = {
       'size' : size,
       'page' : 1,
       #'withExif': True,
       'withStacked': True
     }
-    assets_total = list()
+    if order:
+      payload['order'] = order
 
-    logger.info(f'⬇️  Fetching assets: ')
-    logger.info(f'   Page size: {size}')
+    retries = int(os.environ.get("FETCH_RETRIES", 5))
+    backoff = float(os.environ.get("FETCH_BACKOFF", 1))
+    checkpoint = os.environ.get("FETCH_CHECKPOINT")
+    checkpoint_max_age = float(os.environ.get("FETCH_CHECKPOINT_MAX_AGE", 3600))
+    header = {"api": self.api_url, "order": order}
+    sizer = PageSizer.fromEnvironment(size)
+    self.metrics = sizer.metrics
+    seen = set()
+    pages = 0
+    offset = 0
+    session = self.getSession()
 
-    session = Session()
-    retry = Retry(connect=3, backoff_factor=0.5)
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
+    if checkpoint:
+      saved_pages, offset, saved_size = self._readCheckpoint(checkpoint, header, checkpoint_max_age)
+      if saved_pages:
+        sizer.size = saved_size
+        logger.info(f'   Resuming from checkpoint at asset {offset} ({len(saved_pages)} pages saved)')
+        for items in saved_pages:
+          seen.update(x['id'] for x in items)
+          pages += 1
+          yield items
+      else:
+        with open(checkpoint, "w") as f:
+          f.write(json.dumps(header) + "\n")
 
-    while payload["page"] != None:
-      response = session.post(f"{self.api_url}/search/metadata", headers=self.headers, json=payload)
+    while offset is not None:
+      # Page sizes stay aligned with the offset, see PageSizer
+      payload['size'] = sizer.size
+      payload['page'] = offset // sizer.size + 1
 
-      if not response.ok:
-        logger.error('   Error:', response.status_code, response.text)
+      start = time.monotonic()
+      response_data, page_bytes = self._fetchPage(session, payload, retries, backoff, pages)
+      items = response_data['assets']['items']
+      next_offset = offset + sizer.size if response_data['assets']['nextPage'] != None else None
+      sizer.observe(time.monotonic() - start, page_bytes, next_offset or 0)
+      pages += 1
+
+      if checkpoint:
+        with open(checkpoint, "a") as f:
+          f.write(json.dumps({"items": items, "next": next_offset, "size": payload['size']}, separators=(',', ':')) + "\n")
+        # Pages can shift between runs, drop assets already yielded
+        items = [x for x in items if x['id'] not in seen]
+        seen.update(x['id'] for x in items)
+
+      yield items
+      offset = next_offset
+
+    if checkpoint:
+      os.remove(checkpoint)
+
+  def fetchAssets(self, size: int = 1000) -> list:
+    assets_total = list()
+    pages = 0
+
+    logger.info(f'⬇️  Fetching assets: ')
+    logger.info(f'   Page size: {size}')
 
-      response_data = response.json()
-      assets_total = assets_total + response_data['assets']['items']
-      payload["page"] = response_data['assets']['nextPage']
+    for items in self.iterPages(size):
+      assets_total.extend(items)
+      pages += 1
     
     self.assets = assets_total
     
-    logger.info(f'   Pages: {payload["page"]}')   
+    logger.info(f'   Pages: {pages}')   
     logger.info(f'   Assets: {len(self.assets)}')
+    log_fetch_metrics(self.metrics)
     
     return self.assets
 
-  def modifyAssets(self, payload: dict) -> None:
-    session = Session()
-    retry = Retry(connect=3, backoff_factor=0.5)
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
+  def fetchSample(self, size: int, random: bool = False) -> list:
+    """
+    A sample for the pre-flight check: the first `size` assets in fetch
+    order, or `size` assets picked by /search/random. The size is capped at
+    server_page_limit, a larger sample would need several requests.
+    """
+    size = min(size, server_page_limit)
+    retries = int(os.environ.get("FETCH_RETRIES", 5))
+    backoff = float(os.environ.get("FETCH_BACKOFF", 1))
+    payload = {'size': size, 'withStacked': True}
+    if random:
+      items, _ = self._fetchPage(self.getSession(), payload, retries, backoff, 0, '/search/random')
+      return items
+    payload['page'] = 1
+    response_data, _ = self._fetchPage(self.getSession(), payload, retries, backoff, 0)
+    return response_data['assets']['items']
 
-    response = session.put(f"{self.api_url}/assets", headers=self.headers, json=payload)
+  def fetchExif(self, ids: list, workers: int = 4, batch_size: int = 200) -> dict:
+    """
+    Fetch exifInfo for the given asset ids only, `workers` requests at a time
+    and one batch of ids after the other. Assets that fail are left out.
+    """
+    def get(asset_id):
+      try:
+        response = self.getSession().get(f"{self.api_url}/assets/{asset_id}", headers=self.headers)
+      except RequestException as e:
+        logger.warning(f'   EXIF for {asset_id} failed: {type(e).__name__}')
+        return asset_id, None
+      if not response.ok:
+        logger.warning(f'   EXIF for {asset_id} failed: {response.status_code}')
+        return asset_id, None
+      return asset_id, response.json().get("exifInfo")
+
+    self.ensurePoolSize(workers)
+    exif = {}
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="exif") as pool:
+      for start in range(0, len(ids), batch_size):
+        for asset_id, exif_info in pool.map(get, ids[start:start + batch_size]):
+          if exif_info is not None:
+            exif[asset_id] = exif_info
+        log_detail(f'   EXIF: {min(start + batch_size, len(ids))}/{len(ids)}')
+    return exif
+
+  def modifyAssets(self, payload: dict) -> bool:
+    response = self.getSession().put(f"{self.api_url}/assets", headers=self.headers, json=payload)
 
     if response.ok:
-      logger.info("  🟢 Success!")
+      log_detail("  🟢 Success!")
     else:
       logger.error(f"  🔴 Error! {response.status_code} {response.text}") 
 
+    return response.ok
+
+
+class MutationExecutor():
+  """
+  Runs stacking requests with at most `workers` in flight over the shared
+  connection pool. Stacks are independent since an asset belongs to a single
+  group, so their order does not matter. Failures are collected and returned
+  sorted by stack index by close().
+  """
+  def __init__(self, immich: Immich, workers: int = 1, delay: float = 0.1):
+    self.immich = immich
+    self.delay = delay
+    self.failures = []
+    self.pool = None
+    if workers > 1:
+      immich.ensurePoolSize(workers)
+      from concurrent.futures import ThreadPoolExecutor
+      self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mutation")
+      # Bound the queued stacks as well, not only the running ones
+      self.slots = threading.BoundedSemaphore(workers * 2)
+      self.lock = threading.Lock()
+
+  def _run(self, payloads: list):
+    for payload in payloads:
+      if self.delay:
+        time.sleep(self.delay)
+      try:
+        ok = self.immich.modifyAssets(payload)
+      except Exception as e:
+        return f'{type(e).__name__}: {e}'
+      if ok is False:
+        return 'request failed'
+    return None
+
+  def _runInPool(self, i: int, key, payloads: list) -> None:
+    try:
+      error = self._run(payloads)
+      if error:
+        with self.lock:
+          self.failures.append((i, key, error))
+    finally:
+      self.slots.release()
+
+  def submit(self, i: int, key, payloads: list) -> None:
+    if self.pool is None:
+      error = self._run(payloads)
+      if error:
+        self.failures.append((i, key, error))
+      return
+    self.slots.acquire()
+    self.pool.submit(self._runInPool, i, key, payloads)
+
+  def close(self) -> list:
+    if self.pool is not None:
+      self.pool.shutdown(wait=True)
+    return sorted(self.failures, key=lambda failure: failure[0])
+
+
+class RunLock():
+  """
+  Keeps runs from overlapping when one takes longer than the cron interval.
+
+  Uses an advisory flock on LOCK_FILE where available: the kernel drops it
+  when a run exits or crashes, so stale locks recover by themselves. Without
+  fcntl (Windows), the lockfile is created exclusively and considered stale
+  once its heartbeat is older than `stale_seconds`; a PID cannot be probed
+  there, os.kill(pid, 0) would send a console event instead. A stale file is
+  taken over by renaming a new one over it, never by removing it first. The
+  file holds the PID, a token, the start time and a heartbeat refreshed while
+  the run is alive.
+  """
+  # How long a takeover waits before reading back the lockfile, so that the
+  # last of several racing runs is the only one to find its own token
+  settle_seconds = 0.2
+
+  def __init__(self, path: str, wait: float = 0, stale_seconds: float = 600, heartbeat: float = 30):
+    self.path = path
+    self.wait = wait
+    self.stale_seconds = stale_seconds
+    self.heartbeat = heartbeat
+    self.started = time.time()
+    self.token = os.urandom(8).hex()
+    self.fd = None
+    self.acquired = False
+    self.stopped = threading.Event()
+    self.thread = None
+
+  @classmethod
+  def fromEnvironment(cls) -> 'RunLock':
+    return cls(
+      os.environ.get("LOCK_FILE", os.path.join(tempfile.gettempdir(), "immich_auto_stack.lock")),
+      wait=float(os.environ.get("LOCK_WAIT", 0)),
+      stale_seconds=float(os.environ.get("LOCK_STALE_SECONDS", 600)),
+    )
+
+  def __enter__(self) -> 'RunLock':
+    self.acquired = self.acquire()
+    return self
+
+  def __exit__(self, *exc) -> None:
+    self.release()
+
+  def holder(self) -> dict:
+    try:
+      with open(self.path) as f:
+        return json.loads(f.read() or '{}')
+    except (OSError, ValueError):
+      return {}
+
+  def _content(self) -> bytes:
+    return json.dumps({
+      "pid": os.getpid(), "token": self.token, "started": self.started, "heartbeat": time.time()
+    }).encode()
+
+  def _write(self) -> None:
+    os.ftruncate(self.fd, 0)
+    os.lseek(self.fd, 0, os.SEEK_SET)
+    os.write(self.fd, self._content())
+
+  def _isStale(self, holder: dict) -> bool:
+    heartbeat = holder.get("heartbeat")
+    if heartbeat is None:
+      # Created but not written yet, judge it by its modification time
+      try:
+        heartbeat = os.path.getmtime(self.path)
+      except OSError:
+        return True
+    return time.time() - heartbeat > self.stale_seconds
+
+  def _takeOver(self, stale: dict) -> bool:
+    directory = os.path.dirname(os.path.abspath(self.path))
+    fd, temp = tempfile.mkstemp(dir=directory, prefix=".immich_auto_stack.", suffix=".lock")
+    try:
+      os.write(fd, self._content())
+      os.close(fd)
+      if self.holder() != stale:
+        # Taken over or refreshed since it was found stale
+        return False
+      os.replace(temp, self.path)
+    except OSError:
+      # On Windows a lockfile still open in a live run cannot be replaced
+      return False
+    finally:
+      if os.path.exists(temp):
+        os.remove(temp)
+
+    time.sleep(self.settle_seconds)
+    self.fd = os.open(self.path, os.O_RDWR)
+    data = os.read(self.fd, 4096)
+    try:
+      owner = json.loads(data or b'{}').get("token")
+    except ValueError:
+      owner = None
+    if owner != self.token:
+      os.close(self.fd)
+      self.fd = None
+      return False
+    logger.warning(f'🔓  Took over stale lock {self.path} left by PID {stale.get("pid")}')
+    return True
+
+  def _tryLock(self) -> bool:
+    if fcntl is not None:
+      fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        os.close(fd)
+        return False
+      self.fd = fd
+      return True
+
+    try:
+      self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+      return True
+    except FileExistsError:
+      holder = self.holder()
+      return self._isStale(holder) and self._takeOver(holder)
+
+  def _beat(self) -> None:
+    while not self.stopped.wait(self.heartbeat):
+      self._write()
+
+  def acquire(self) -> bool:
+    if self.path is None:
+      # No lock for runs that cannot overlap with any other
+      return True
+    deadline = time.monotonic() + self.wait
+    while not self._tryLock():
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return False
+      time.sleep(min(remaining, 1))
+
+    self._write()
+    self.thread = threading.Thread(target=self._beat, name="lock-heartbeat", daemon=True)
+    self.thread.start()
+    return True
+
+  def release(self) -> None:
+    if self.fd is None:
+      return
+    self.stopped.set()
+    self.thread.join()
+    os.close(self.fd)
+    self.fd = None
+    if fcntl is None and self.holder().get("token") == self.token:
+      # Unless a later run took the lock over after this one stalled
+      try:
+        os.remove(self.path)
+      except OSError:
+        pass
+
+
+# Settings that change what a run would do to an unchanged library
+config_variables = (
+  "CRITERIA", "PARENT_PROMOTE", "PARENT_EXIF_PREFER", "EXIF_CRITERIA", "SKIP_PREVIOUS",
+  "SKIP_MATCH_MISS", "MAX_GROUP_SIZE", "MAX_GROUP_ACTION", "MUTATION_CHUNK_SIZE",
+)
+
+# Settings that the per-asset criteria keys and parent ranks depend on
+key_variables = ("CRITERIA", "PARENT_PROMOTE", "SKIP_MATCH_MISS")
+
+def config_fingerprint(variables: tuple = config_variables) -> str:
+  import hashlib
+  config = json.dumps([os.environ.get(name) for name in variables])
+  return hashlib.sha256(config.encode()).hexdigest()[:16]
+
+class ChangeDetector():
+  """
+  Lets a tick skip the full fetch when nothing was added or modified since
+  the last complete run.
+
+  The start time of that run is kept in CHANGE_STATE_FILE along with the
+  server and a fingerprint of the stacking settings. A tick asks for a single
+  asset updated after it. The request goes through urllib from the standard
+  library, so an idle tick never imports requests. Any doubt (no state,
+  changed settings, an error) means a full run.
+  """
+  # Allows for clock skew between this host and the server
+  margin = 300
+
+  def __init__(self, path: str, api_url: str, api_key: str, timeout: float = 10):
+    self.path = path
+    self.api_url = api_root(api_url)
+    self.api_key = api_key
+    self.timeout = timeout
+    self.fingerprint = config_fingerprint()
+
+  @classmethod
+  def fromEnvironment(cls, api_url: str, api_key: str) -> 'ChangeDetector':
+    if not str2bool(os.environ.get("CHANGE_DETECTION", False)):
+      return None
+    return cls(
+      os.environ.get("CHANGE_STATE_FILE", os.path.join(tempfile.gettempdir(), "immich_auto_stack.state.json")),
+      api_url,
+      api_key,
+    )
+
+  def since(self) -> str:
+    """ISO time of the last complete run with the same server and settings, or None"""
+    try:
+      with open(self.path) as f:
+        state = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if state.get("api") != self.api_url or state.get("config") != self.fingerprint:
+      return None
+    return state.get("since")
+
+  def unchanged(self) -> bool:
+    since = self.since()
+    if since is None:
+      return False
+
+    import urllib.request
+    request = urllib.request.Request(
+      f'{self.api_url}/search/metadata',
+      data=json.dumps({"size": 1, "updatedAfter": since, "withStacked": True}).encode(),
+      headers={'x-api-key': self.api_key, 'Accept': 'application/json', 'Content-Type': 'application/json'},
+      method='POST',
+    )
+    try:
+      with urllib.request.urlopen(request, timeout=self.timeout) as response:
+        items = json.load(response)["assets"]["items"]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      logger.info(f'⚠️  Change detection failed ({e}), running anyway')
+      return False
+    return not items
+
+  def record(self, started: float) -> None:
+    since = datetime.fromtimestamp(started - self.margin, timezone.utc).isoformat()
+    state = {"api": self.api_url, "config": self.fingerprint, "since": since}
+    tmp = f'{self.path}.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(state, f)
+    os.replace(tmp, self.path)
+
+
+class KeyCache():
+  """
+  Criteria keys and parent ranks computed by earlier runs, kept in the
+  SQLite database KEY_CACHE so that only new or modified assets are
+  evaluated again.
+
+  Values are stored per asset id and criteria set name along with the
+  asset's updatedAt, and the whole cache is dropped when a fingerprint of
+  CRITERIA, PARENT_PROMOTE and SKIP_MATCH_MISS changes. evict() removes the
+  entries of assets that are no longer in the library.
+  """
+  def __init__(self, path: str):
+    import sqlite3
+    self.path = path
+    self.hits = 0
+    self.misses = 0
+    self.db = sqlite3.connect(path)
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+      CREATE TABLE IF NOT EXISTS keys (
+        id TEXT, name TEXT, updated TEXT, value TEXT,
+        PRIMARY KEY (id, name)
+      ) WITHOUT ROWID;
+    """)
+    fingerprint = config_fingerprint(key_variables)
+    row = self.db.execute("SELECT value FROM meta WHERE name = 'config'").fetchone()
+    if row is None or row[0] != fingerprint:
+      with self.db:
+        self.db.execute("DELETE FROM keys")
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('config', ?)", (fingerprint,))
+
+  @classmethod
+  def fromEnvironment(cls) -> 'KeyCache':
+    path = os.environ.get("KEY_CACHE")
+    return cls(path) if path else None
+
+  def cached(self, name: str, data: list, compute) -> dict:
+    """Map the id of every asset in data to compute(asset), computing only the missing or outdated ones"""
+    stored = {
+      asset_id: (updated, value)
+      for asset_id, updated, value in self.db.execute("SELECT id, updated, value FROM keys WHERE name = ?", (name,))
+    }
+    values = {}
+    hits = []
+    fresh = []
+    for x in data:
+      asset_id, updated = x["id"], x.get("updatedAt")
+      entry = stored.get(asset_id)
+      if entry is not None and updated is not None and entry[0] == updated:
+        hits.append((asset_id, entry[1]))
+        continue
+      timeouts = len(regex_timeouts)
+      value = values[asset_id] = compute(x)
+      self.misses += 1
+      # A regex that ran out of time may well succeed next time
+      if updated is not None and len(regex_timeouts) == timeouts:
+        fresh.append((asset_id, name, updated, json.dumps(value)))
+
+    # One decode of all the reused values is much faster than one per asset
+    decoded = json.loads(f'[{",".join(value for _, value in hits)}]')
+    values.update(zip((asset_id for asset_id, _ in hits), decoded))
+    self.hits += len(hits)
+
+    with self.db:
+      self.db.executemany("INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)", fresh)
+    return values
+
+  def evict(self, ids) -> int:
+    """Remove the entries of assets whose id is not in ids"""
+    with self.db:
+      self.db.execute("CREATE TEMP TABLE IF NOT EXISTS live (id TEXT PRIMARY KEY)")
+      self.db.execute("DELETE FROM live")
+      self.db.executemany("INSERT OR IGNORE INTO live VALUES (?)", ((asset_id,) for asset_id in ids))
+      removed = self.db.execute("DELETE FROM keys WHERE id NOT IN (SELECT id FROM live)").rowcount
+      self.db.execute("DELETE FROM live")
+    return removed
+
+  def close(self) -> None:
+    self.db.close()
+
+
+def get_memory_budget() -> int:
+  """
+  Return the MEMORY_BUDGET in bytes, or 0 when grouping should stay in memory.
+
+  MEMORY_BUDGET is expressed in megabytes.
+  """
+  budget = os.environ.get("MEMORY_BUDGET")
+  if not budget:
+    return 0
+  return int(float(budget) * 1024 * 1024)
+
+# Most run files open at once during an external merge, well below the
+# default per-process file limits
+merge_fan_in = 64
+
+def _write_run(records, directory: str) -> str:
+  # Write already sorted (key, seq) records to a new run file
+  import pickle
+  fd, path = tempfile.mkstemp(dir=directory, suffix=".run")
+  with os.fdopen(fd, "wb") as f:
+    for record in records:
+      pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+  return path
+
+def _spill_run(run: list, directory: str) -> str:
+  # Write one sorted run of (key, seq) records to disk
+  run.sort()
+  return _write_run(run, directory)
+
+def _read_run(path: str):
+  import pickle
+  with open(path, "rb") as f:
+    while True:
+      try:
+        yield pickle.load(f)
+      except EOFError:
+        return
+
+def _merge_runs(runs: list, directory: str) -> list:
+  """
+  Merge runs in passes of at most merge_fan_in files each, until few enough
+  are left to be merged at once.
+  """
+  while len(runs) > merge_fan_in:
+    merged = []
+    for start in range(0, len(runs), merge_fan_in):
+      batch = runs[start:start + merge_fan_in]
+      merged.append(_write_run(heapq.merge(*[_read_run(path) for path in batch]), directory))
+      for path in batch:
+        os.remove(path)
+    runs = merged
+  return runs
+
+def none_safe_key(key) -> list:
+  """
+  Sort key for a criteria key that holds None, e.g. from an optional regex
+  group. None does not compare with str, so it sorts after any value here.
+  Groups with such keys are rejected by stackBy once grouped.
+  """
+  return [(value is None, value) for value in key]
+
+def _record_size(key: list) -> int:
+  # Rough in-memory size of a buffered (key, seq) record
+  return 120 + sum(sys.getsizeof(value) for value in key)
+
+def externalGroupBy(data: list, criteria, budget: int, skip_miss: bool = False):
+  """
+  Group data by criteria while holding at most roughly `budget` bytes of
+  keys in memory, besides the assets themselves.
+
+  Only (key, seq) records are buffered, seq being the position of the asset
+  in data. Once the buffer grows past the budget it is sorted and spilled to
+  a temporary run file, and the runs are then combined with an external
+  merge, over several passes when there are more than merge_fan_in runs.
+  The groups are rebuilt by indexing into data, so they hold the
+  original asset objects rather than copies. `seq` also preserves the input
+  order of equal keys, so the result matches sorted() + groupby() on the same
+  data.
+  """
+  with tempfile.TemporaryDirectory(prefix="immich_auto_stack_") as directory:
+    runs = []
+    buffer = []
+    buffered = 0
+
+    for seq, asset in enumerate(data):
+      key = criteria(asset)
+      if skip_miss and not key:
+        continue
+      # The group key is always last, keys holding None sort after the others
+      buffer.append(((True, none_safe_key(key), key) if None in key else (False, key), seq))
+      buffered += _record_size(key)
+      if buffered > budget:
+        runs.append(_spill_run(buffer, directory))
+        buffer = []
+        buffered = 0
+
+    if runs:
+      logger.info(f'💾  Spilled {len(runs)} sorted runs to disk')
+      if buffer:
+        runs.append(_spill_run(buffer, directory))
+      records = heapq.merge(*[_read_run(path) for path in _merge_runs(runs, directory)])
+    else:
+      records = sorted(buffer)
+
+    for sort_key, group in groupby(records, key=lambda record: record[0]):
+      yield sort_key[-1], [data[seq] for _, seq in group]
 
 def stackBy(data: list, criteria) -> list:
-  # Optional: remove incompatible file names
-  if str2bool(os.environ.get("SKIP_MATCH_MISS")):
-    data = filter(criteria, data)
+  skip_miss = str2bool(os.environ.get("SKIP_MATCH_MISS"))
+  budget = get_memory_budget()
+
+  if budget:
+    # Sort and group through disk runs above the memory budget
+    groups = externalGroupBy(data, criteria, budget, skip_miss)
+  else:
+    # Optional: remove incompatible file names
+    if skip_miss:
+      data = list(filter(criteria, data))
 
-  # Sort by primary and secondary criteria
-  data = sorted(data, key=criteria)
+    # Sort by primary and secondary criteria
+    try:
+      data = sorted(data, key=criteria)
+    except TypeError:
+      # Some keys hold None, rejected below when they form a group
+      data = sorted(data, key=lambda x: none_safe_key(criteria(x)))
 
-  # Group by primary and secondary criteria
-  groups = groupby(data, key=criteria)
+    # Group by primary and secondary criteria
+    groups = groupby(data, key=criteria)
   
   # Extract and process groups into a list of tuples
-  groups = [(key, list(group)) for key, group in groups]
+  groups = ((key, list(group)) for key, group in groups)
   
   # Filter only groups that have more than one item
   groups = [x for x in groups if len(x[1]) > 1 ] 
@@ -183,10 +1334,747 @@ def stackBy(data: list, criteria) -> list:
 
   return groups
 
+def stackByColumnar(data: list, config: list = None):
+  """
+  Columnar equivalent of stackBy(data, apply_criteria).
+
+  Each criteria field is pulled out as a column and the split/regex modifiers
+  run column at a time over the assets still holding a key, instead of one
+  asset at a time. The keys are then factorized and grouped in bulk with
+  pandas. Returns None when pandas is not installed or when the data holds
+  something only the pure-Python path handles exactly (non string values, out
+  of range split index, ...), so the caller can fall back.
+  """
+  try:
+    import numpy as np
+    import pandas as pd
+  except ImportError:
+    return None
+
+  config = config or get_criteria_config()
+  skip_miss = str2bool(os.environ.get("SKIP_MATCH_MISS"))
+  if not config or uses_prefix(config):
+    return None
+
+  # Row numbers of the assets still being evaluated and their key columns
+  rows = list(range(len(data)))
+  columns = []
+  empty = []
+  first_error = None
+
+  def keep(mask):
+    nonlocal rows, columns
+    rows = list(compress(rows, mask))
+    columns = [list(compress(column, mask)) for column in columns]
+
+  for item in config:
+    field = item["key"]
+    column = [data[row].get(field) for row in rows]
+
+    # A None value ends the key evaluation of that asset with an empty key
+    if None in column:
+      mask = [value is not None for value in column]
+      empty.extend(row for row, present in zip(rows, mask) if not present)
+      column = list(compress(column, mask))
+      keep(mask)
+
+    if ("split" in item or "regex" in item) and any(type(value) is not str for value in column):
+      return None
+
+    if "split" in item:
+      split_key = item["split"]["key"]
+      split_index = item["split"]["index"]
+      try:
+        column = [value.split(split_key)[split_index] for value in column]
+      except (IndexError, ValueError):
+        return None
+
+    if "regex" in item:
+      if str2bool(os.environ.get("REGEX_SAFE", False)):
+        # Per-match time budgets are handled by the Python engine
+        return None
+      regex_key = item["regex"]["key"]
+      regex_index = item["regex"].get("index", 1)
+      try:
+        compiled = re.compile(regex_key)
+      except re.error:
+        return None
+      matches = list(map(compiled.match, column))
+      if None in matches:
+        mask = [match is not None for match in matches]
+        missed = [row for row, hit in zip(rows, mask) if not hit]
+        if not skip_miss:
+          row = missed[0]
+          if first_error is None or row < first_error[0]:
+            first_error = (row, data[row][field], regex_key)
+        else:
+          empty.extend(missed)
+        matches = list(compress(matches, mask))
+        keep(mask)
+      try:
+        column = [match.group(regex_index) for match in matches]
+      except IndexError:
+        return None
+
+    columns.append(column)
+
+  if first_error is not None:
+    _, value, regex_key = first_error
+    raise Exception(f"Match not found for value: {value}, regex: {regex_key}")
+
+  groups = []
+  if rows:
+    # Sorted factorization per column, then a stable lexicographic sort of the
+    # codes orders the rows exactly like sorted() orders the key lists
+    try:
+      codes = [pd.factorize(pd.Series(column, dtype=object), sort=True, use_na_sentinel=False)[0] for column in columns]
+    except TypeError:
+      return None
+    order = np.lexsort(codes[::-1]) if codes else np.arange(len(rows))
+    codes = np.stack(codes)[:, order] if codes else np.zeros((1, len(rows)), dtype=int)
+    bounds = np.flatnonzero((np.diff(codes, axis=1) != 0).any(axis=0)) + 1
+    bounds = [0] + bounds.tolist() + [len(rows)]
+    order = order.tolist()
+
+    for start, end in zip(bounds, bounds[1:]):
+      if end - start > 1:
+        positions = order[start:end]
+        key = [column[positions[0]] for column in columns]
+        groups.append((key, [data[rows[position]] for position in positions]))
+
+  if not skip_miss and len(empty) > 1:
+    # Mirrors stackBy: several keyless photos would form an empty-key group
+    groups.insert(0, ([], [data[row] for row in sorted(empty)]))
+
+  if any((group[0] == [] or None in group[0]) for group in groups):
+      raise Exception(
+          "Some photos do not match the criteria you provided. Consider refining your"
+          "criteria. If the criteria was not intended to match all files, use the"
+          "SKIP_MATCH_MISS environment variable to skip processing of those photos."
+      )
+
+  return groups
+
+def cachedCriteria(key_cache: KeyCache, name: str, data: list, config: list):
+  """
+  The criteria function of config, answered from KEY_CACHE for the assets in
+  data. Prefix rules depend on the other assets, so they are never cached.
+  """
+  criteria = lambda x: apply_criteria(x, config)
+  if key_cache is None or uses_prefix(config):
+    return criteria
+  keys = key_cache.cached(name, data, criteria)
+  return lambda x: keys[x["id"]]
+
+def stackByRuleSets(data: list, criteria_sets: list, columnar: bool = False, key_cache: KeyCache = None,
+                    max_size: int = 0, action: str = 'warn') -> list:
+  """
+  Group the same assets by several named rule sets in one pass.
+
+  Sets are applied in order and an asset stacked by a set is no longer
+  available to the following ones, so the first set listed wins when two
+  sets would claim the same asset. The set name is prepended to the keys.
+  The groups of each set go through limitGroups before their assets are
+  claimed, so a group skipped as too large leaves its assets to later sets.
+  """
+  claimed = set()
+  groups = []
+  for name, config in criteria_sets:
+    remaining = [x for x in data if x['id'] not in claimed]
+    resolvePrefixes(remaining, config)
+    set_groups = stackByColumnar(remaining, config) if columnar else None
+    if set_groups is None:
+      set_groups = stackBy(remaining, cachedCriteria(key_cache, name, remaining, config))
+    set_groups = list(limitGroups(set_groups, max_size, action))
+
+    logger.info(f'   Criteria "{name}": {len(set_groups)} groups')
+    for key, stack in set_groups:
+      claimed.update(x['id'] for x in stack)
+      groups.append(([name] + key, stack))
+  return groups
+
+# Ids of the assets in groups held back by refineWithExif during this run
+exif_held_back = []
+
+def refineWithExif(immich: Immich, groups: list, exif_config: list, skip_previous: bool = False) -> list:
+  """
+  Second phase of EXIF-aware stacking. The candidate groups were found from
+  the light metadata; EXIF is fetched only for their assets, attached as
+  exifInfo and, with EXIF_CRITERIA, used to split each group further. The
+  EXIF keys are appended to the group key.
+
+  With skip_previous, groups whose assets are all stacked already are
+  skipped by plan_stack anyway, so they are passed on without EXIF.
+  EXIF_CRITERIA misses are not errors: a group with a failed EXIF fetch is
+  held back until a later run, its asset ids listed in exif_held_back, and
+  assets lacking a criteria field are left out of the refined groups.
+  """
+  pending = [
+    not skip_previous or any(x.get('stackCount') is None for x in stack)
+    for _, stack in groups
+  ]
+  ids = [x['id'] for (_, stack), needed in zip(groups, pending) if needed for x in stack]
+  logger.info(f'🔍  Fetching EXIF for {len(ids)} candidate assets')
+  exif = immich.fetchExif(
+    ids,
+    workers=int(os.environ.get("EXIF_WORKERS", 4)),
+    batch_size=int(os.environ.get("EXIF_BATCH_SIZE", 200))
+  ) if ids else {}
+
+  def exif_key(x):
+    try:
+      return apply_criteria(x["exifInfo"], exif_config)
+    except Exception:
+      # A regex miss with SKIP_MATCH_MISS off, which only aborts on CRITERIA
+      return []
+
+  refined = []
+  held_back = 0
+  missed = 0
+  for (key, stack), needed in zip(groups, pending):
+    if not needed:
+      refined.append((key, stack))
+      continue
+    stack = [{**x, "exifInfo": exif.get(x['id'])} for x in stack]
+    if not exif_config:
+      refined.append((key, stack))
+      continue
+    if any(x["exifInfo"] is None for x in stack):
+      held_back += 1
+      exif_held_back.extend(x['id'] for x in stack)
+      continue
+    keys = {x['id']: exif_key(x) for x in stack}
+    missed += sum(1 for x in stack if not keys[x['id']])
+    stack = sorted((x for x in stack if keys[x['id']]), key=lambda x: keys[x['id']])
+    for exif_group_key, substack in groupby(stack, key=lambda x: keys[x['id']]):
+      substack = list(substack)
+      if len(substack) > 1:
+        refined.append((key + exif_group_key, substack))
+
+  if held_back:
+    logger.warning(f'⚠️  {held_back} groups held back until a later run, their EXIF could not be fetched')
+  if missed:
+    logger.info(f'   {missed} assets without the EXIF_CRITERIA fields left out')
+  logger.info(f'   Groups: {len(groups)} candidates, {len(refined)} after EXIF')
+  return refined
+
+def parse_datetime(value: str) -> datetime:
+  # Immich timestamps are ISO 8601 with a "Z" suffix, which fromisoformat
+  # only accepts from Python 3.11
+  return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+
+def pipeline_supported(config: list) -> bool:
+  """
+  Streaming needs the raw localDateTime in the key, so that a group can be
+  closed once the fetch has moved past its timestamp.
+  """
+  return any(
+    item["key"] == "localDateTime" and "split" not in item and "regex" not in item
+    for item in config
+  )
+
+def stackByStream(pages, criteria, window_hours: float = 24):
+  """
+  Streaming stackBy over pages ordered ascending by fileCreatedAt.
+
+  localDateTime is fileCreatedAt shifted by the timezone offset of the photo
+  (-12h to +14h), so once the fetch has reached fileCreatedAt T no asset with
+  a localDateTime before T - window can still arrive. Groups older than that
+  are yielded while later pages are still downloading; the rest are flushed
+  at the end. The groups match stackBy, though not in the same order.
+  """
+  skip_miss = str2bool(os.environ.get("SKIP_MATCH_MISS"))
+  window = timedelta(hours=window_hours)
+  open_groups = {}
+  pending = []
+  sequence = count()
+  empty = 0
+  sweep = None
+
+  def close(key):
+    stack = open_groups.pop(key)
+    if len(stack) > 1:
+      if None in key:
+        raise Exception(
+            "Some photos do not match the criteria you provided. Consider refining your"
+            "criteria. If the criteria was not intended to match all files, use the"
+            "SKIP_MATCH_MISS environment variable to skip processing of those photos."
+        )
+      return list(key), stack
+
+  for page in pages:
+    for asset in page:
+      key = criteria(asset)
+      if not key:
+        if skip_miss:
+          continue
+        empty += 1
+        if empty > 1:
+          raise Exception(
+              "Some photos do not match the criteria you provided. Consider refining your"
+              "criteria. If the criteria was not intended to match all files, use the"
+              "SKIP_MATCH_MISS environment variable to skip processing of those photos."
+          )
+        continue
+
+      key = tuple(key)
+      if key in open_groups:
+        open_groups[key].append(asset)
+      else:
+        open_groups[key] = [asset]
+        heapq.heappush(pending, (parse_datetime(asset["localDateTime"]), next(sequence), key))
+
+      created = parse_datetime(asset["fileCreatedAt"])
+      if sweep is None or created > sweep:
+        sweep = created
+
+    while pending and pending[0][0] < sweep - window:
+      group = close(heapq.heappop(pending)[2])
+      if group:
+        yield group
+
+  while pending:
+    group = close(heapq.heappop(pending)[2])
+    if group:
+      yield group
+
+def runPipeline(groups, handle) -> tuple:
+  """
+  Hand each group to `handle(i, key, stack)` on a mutation worker thread
+  while `groups` keeps fetching. Returns (processed, total).
+  """
+  work = queue.Queue(maxsize=1000)
+  processed = 0
+  total = 0
+  error = None
+
+  def worker():
+    nonlocal processed, error
+    while True:
+      item = work.get()
+      if item is None:
+        return
+      if error is not None:
+        # Keep draining so the fetch never blocks on a full queue
+        continue
+      try:
+        if handle(*item):
+          processed += 1
+      except Exception as e:
+        error = e
+
+  thread = threading.Thread(target=worker, name="mutations", daemon=True)
+  thread.start()
+  try:
+    for key, stack in groups:
+      if error is not None:
+        break
+      work.put((total, key, stack))
+      total += 1
+  finally:
+    work.put(None)
+    thread.join()
+
+  if error is not None:
+    raise error
+
+  return processed, total
+
+SNAPSHOT_MAGIC = b'IASNAP1\n'
+SNAPSHOT_SCALARS = (str, int, float, bool, type(None))
+# Nested values kept as scalar columns: the stack object is the only stack
+# marker on newer servers, and AUDIT needs it
+SNAPSHOT_NESTED = {"stackPrimaryAssetId": ("stack", "primaryAssetId")}
+
+def snapshot_value(asset: dict, field: str) -> tuple:
+  # (present, value) of a snapshot column for one asset
+  if field in SNAPSHOT_NESTED:
+    parent, child = SNAPSHOT_NESTED[field]
+    nested = asset.get(parent)
+    if isinstance(nested, dict) and child in nested:
+      return True, nested[child]
+    return False, None
+  if field in asset:
+    return True, asset[field]
+  return False, None
+
+def saveSnapshot(assets: list, path: str) -> None:
+  """
+  Save the scalar asset metadata to a compact columnar snapshot file.
+
+  Layout: magic, a 4-byte header length, a JSON header mapping each column to
+  its (offset, length), then one zlib-compressed JSON blob per column holding
+  [values, missing_indices]. Nested fields (exif, stacked assets) are not
+  stored, except those in SNAPSHOT_NESTED. Columns can be read independently
+  through mmap.
+  """
+  fields = {}
+  for asset in assets:
+    for field, value in asset.items():
+      if isinstance(value, SNAPSHOT_SCALARS):
+        fields.setdefault(field, None)
+    for field in SNAPSHOT_NESTED:
+      if snapshot_value(asset, field)[0]:
+        fields.setdefault(field, None)
+
+  blobs = {}
+  for field in fields:
+    values = []
+    missing = []
+    for index, asset in enumerate(assets):
+      present, value = snapshot_value(asset, field)
+      values.append(value)
+      if not present:
+        missing.append(index)
+    blobs[field] = zlib.compress(json.dumps([values, missing], separators=(',', ':')).encode())
+
+  columns = {}
+  offset = 0
+  for field, blob in blobs.items():
+    columns[field] = [offset, len(blob)]
+    offset += len(blob)
+  header = json.dumps({"count": len(assets), "columns": columns}).encode()
+
+  tmp_path = f'{path}.tmp'
+  with open(tmp_path, "wb") as f:
+    f.write(SNAPSHOT_MAGIC)
+    f.write(struct.pack('<I', len(header)))
+    f.write(header)
+    for blob in blobs.values():
+      f.write(blob)
+  os.replace(tmp_path, path)
+
+  logger.info(f'💾  Snapshot saved: {path} ({len(assets)} assets, {len(columns)} columns)')
+
+def loadSnapshot(path: str, fields: list = None) -> list:
+  """
+  Load assets from a snapshot written by saveSnapshot. When `fields` is given
+  only those columns are decoded. SNAPSHOT_NESTED columns are restored into
+  their nested object.
+  """
+  with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+      raise Exception(f"{path} is not an immich-auto-stack snapshot")
+    position = len(SNAPSHOT_MAGIC)
+    (header_length,) = struct.unpack('<I', data[position:position + 4])
+    position += 4
+    header = json.loads(data[position:position + header_length])
+    position += header_length
+
+    assets = [{} for _ in range(header["count"])]
+    for field, (offset, length) in header["columns"].items():
+      parent, child = SNAPSHOT_NESTED.get(field, (field, None))
+      if fields is not None and parent not in fields:
+        continue
+      start = position + offset
+      values, missing = json.loads(zlib.decompress(data[start:start + length]))
+      missing = set(missing)
+      for index, value in enumerate(values):
+        if index in missing:
+          continue
+        if child is None:
+          assets[index][field] = value
+        else:
+          assets[index].setdefault(parent, {})[child] = value
+
+  logger.info(f'📂  Snapshot loaded: {path} ({len(assets)} assets)')
+  return assets
+
+# Parent ranks reused from KEY_CACHE, by asset id
+parent_ranks = {}
+
+def parent_rank(x: dict) -> list:
+  rank = parent_ranks.get(x.get("id"))
+  return rank if rank is not None else parent_criteria(x)
+
 def stratifyStack(stack: list) -> list:
   # Ensure the desired parent is first in the list
-  return sorted(stack, key=parent_criteria)
+  return sorted(stack, key=parent_rank)
+
+
+def plan_stack(i: int, total, key, stack: list, skip_previous: bool) -> list:
+  """
+  Pick the parent and children of a group and return the PUT /assets
+  payloads that stack them. An empty list means the group is skipped.
+  """
+  stack = stratifyStack(stack)
+
+  parent_id = stack[0]['id']
+  children_id = []
+  
+  if skip_previous:
+    children_id = [x['id'] for x in stack[1:] if x['stackCount'] == None ]
+    
+    if len(children_id) == 0:
+      log_detail(f'{i}/{total} Key: {key} SKIP! No new children!')
+      return []
+    
+  else:
+    children_id = [x['id'] for x in stack[1:]]
+
+  log_detail(f'{i}/{total} Key: {key}')
+  log_detail(f'   Parent name: {stack[0]["originalFileName"]} ID: {parent_id}')
+  
+  for child in stack[1:]:
+    log_detail(f'   Child name:  {child["originalFileName"]} ID: {child["id"]}')
+
+  # Large ids lists time out on the server, send them in chunks
+  chunk_size = int(os.environ.get("MUTATION_CHUNK_SIZE", 500))
+
+  return [
+    {
+      "ids": children_id[start:start + chunk_size],
+      "stackParentId": parent_id
+    }
+    for start in range(0, len(children_id), chunk_size)
+  ]
+
+
+def group_size_histogram(groups: list) -> dict:
+  """
+  Count groups by size in power of two buckets: "2", "3-4", "5-8", ...
+  """
+  histogram = {}
+  for size in sorted(len(stack) for _, stack in groups):
+    upper = 2
+    while upper < size:
+      upper *= 2
+    bucket = str(upper) if upper == 2 else f'{upper // 2 + 1}-{upper}'
+    histogram[bucket] = histogram.get(bucket, 0) + 1
+  return histogram
 
+def log_group_sizes(groups: list) -> None:
+  logger.info(f'📊  Group sizes ({len(groups)} groups):')
+  for bucket, groups_in_bucket in group_size_histogram(groups).items():
+    logger.info(f'   {bucket:>11}: {groups_in_bucket}')
+
+def preflight(sample: list, criteria_sets: list, min_match: float = 0.0) -> list:
+  """
+  Run every criteria set over a sample of the library and log the match
+  rate, the number of distinct keys and the group sizes to expect.
+
+  Returns the problems that make a full fetch pointless, empty when the
+  criteria look sane: misses that would fail the run without
+  SKIP_MATCH_MISS, a match rate at or below `min_match`, or every matching
+  asset sharing a single key.
+  """
+  skip_miss = str2bool(os.environ.get("SKIP_MATCH_MISS"))
+  max_group_size = int(os.environ.get("MAX_GROUP_SIZE", 50))
+  problems = []
+  if not sample:
+    return problems
+
+  for name, config in criteria_sets:
+    resolvePrefixes(sample, config)
+    groups = {}
+    misses = []
+    for x in sample:
+      try:
+        key = apply_criteria(x, config)
+      except Exception:
+        key = []
+      if key:
+        groups.setdefault(tuple(key), []).append(x)
+      else:
+        misses.append(x)
+
+    matched = len(sample) - len(misses)
+    rate = matched / len(sample)
+    stacks = [(list(key), stack) for key, stack in groups.items() if len(stack) > 1]
+    logger.info(
+      f'🧪  Pre-flight "{name}" on {len(sample)} assets: {rate:.0%} match, '
+      f'{len(groups)} distinct keys, {len(stacks)} groups'
+    )
+    for bucket, groups_in_bucket in group_size_histogram(stacks).items():
+      logger.info(f'   {bucket:>11}: {groups_in_bucket}')
+
+    if misses and not skip_miss:
+      problems.append(
+        f'{len(misses)} of {len(sample)} sampled assets do not match "{name}", e.g. '
+        f'{misses[0].get("originalFileName")}. The full run would fail, fix CRITERIA or set SKIP_MATCH_MISS'
+      )
+    elif not matched or rate <= min_match:
+      problems.append(f'Only {rate:.1%} of the sampled assets match "{name}"')
+    if len(groups) == 1 and matched >= 10:
+      problems.append(f'All {matched} matching sampled assets share the key {next(iter(groups))} in "{name}"')
+
+    largest = max((len(stack) for stack in groups.values()), default=0)
+    if max_group_size and largest > max_group_size:
+      logger.warning(f'⚠️  The sample already holds a group of {largest} assets, more than MAX_GROUP_SIZE {max_group_size}')
+  return problems
+
+# Ids of the assets in groups skipped by limitGroups during this run
+skipped_oversized = []
+
+def limitGroups(groups, max_size: int, action: str = 'warn'):
+  """
+  Guard against pathologically large groups, usually the sign of a bad
+  CRITERIA or a camera reusing filenames and timestamps.
+
+  `action` is "warn" to only report them, "skip" to leave them unstacked or
+  "split" to stack them in consecutive chunks of at most `max_size` assets,
+  ordered by parent priority.
+  """
+  for key, stack in groups:
+    if not max_size or len(stack) <= max_size:
+      yield key, stack
+      continue
+
+    logger.warning(f'⚠️  Key: {key} has {len(stack)} assets, more than MAX_GROUP_SIZE {max_size} ({action})')
+    if action == 'skip':
+      skipped_oversized.extend(x['id'] for x in stack)
+      continue
+    if action == 'split':
+      stack = stratifyStack(stack)
+      for start in range(0, len(stack), max_size):
+        chunk = stack[start:start + max_size]
+        if len(chunk) > 1:
+          yield key, chunk
+      continue
+    yield key, stack
+
+
+def existing_stack(x: dict):
+  """Id of the primary asset of the stack that x belongs to, or None"""
+  if x.get("stackParentId"):
+    return x["stackParentId"]
+  stack = x.get("stack")
+  if isinstance(stack, dict) and stack.get("primaryAssetId"):
+    return stack["primaryAssetId"]
+  if x.get("stackCount"):
+    # The primary asset itself, on servers that only set stackParentId on children
+    return x["id"]
+  return None
+
+def auditStacks(assets: list, groups: list, unknown=()) -> tuple:
+  """
+  Compare the stacks that exist on the server, as seen in the fetched
+  assets, with the groups produced by the current criteria.
+
+  `unknown` lists the ids of assets whose group could not be decided this
+  run (EXIF held back, regex timeouts, oversized groups skipped). They are
+  missing from `groups` without being unrelated, so stacks holding them,
+  and stacks sharing a group with those, are left out of the audit.
+
+  Returns (mismatches, unstack, restack). Each mismatch is (kind, primary
+  id, member ids), where kind is "split" when the stack holds assets that
+  are not grouped together, "parent" when parent priority now picks another
+  parent and "merge" when one group is spread over several stacks. `unstack`
+  lists the ids to take out of their stack, and `restack` the groups to
+  stack again in full once they are.
+  """
+  desired = {}
+  parents = []
+  for g, (key, stack) in enumerate(groups):
+    parents.append(stratifyStack(stack)[0]['id'])
+    for x in stack:
+      desired[x['id']] = g
+
+  stacks = {}
+  for x in assets:
+    primary = existing_stack(x)
+    if primary:
+      stacks.setdefault(primary, []).append(x['id'])
+
+  targets = {}
+  owners = {}
+  for primary, members in stacks.items():
+    targets[primary] = {desired.get(member) for member in members}
+    for g in targets[primary] - {None}:
+      owners.setdefault(g, []).append(primary)
+
+  unknown = set(unknown)
+  uncertain = {primary for primary, members in stacks.items() if unknown.intersection(members)}
+  for primary in list(uncertain):
+    for g in targets[primary] - {None}:
+      uncertain.update(owners[g])
+  if uncertain:
+    logger.info(f'🔎  {len(uncertain)} existing stacks left out, some of their assets could not be grouped this run')
+
+  mismatches = []
+  unstacked = []
+  restack = set()
+  for primary, members in stacks.items():
+    if primary in uncertain:
+      continue
+    groups_of_stack = targets[primary]
+    g = next(iter(groups_of_stack))
+    if len(groups_of_stack) != 1 or g is None:
+      kind = 'split'
+    elif len(owners[g]) > 1:
+      kind = 'merge'
+    elif parents[g] != primary:
+      kind = 'parent'
+    else:
+      continue
+    mismatches.append((kind, primary, members))
+    unstacked.append(primary)
+    restack.update(groups_of_stack - {None})
+
+  unstack = [member for primary in unstacked for member in stacks[primary]]
+  return mismatches, unstack, [groups[g] for g in sorted(restack)]
+
+def report_audit(mismatches: list) -> None:
+  if not mismatches:
+    logger.info('🔎  All existing stacks match the current criteria')
+    return
+  kinds = {}
+  for kind, _, _ in mismatches:
+    kinds[kind] = kinds.get(kind, 0) + 1
+  summary = ', '.join(f'{stacks_of_kind} {kind}' for kind, stacks_of_kind in sorted(kinds.items()))
+  logger.warning(f'🔎  {len(mismatches)} existing stacks do not match the current criteria ({summary})')
+  for kind, primary, members in mismatches:
+    log_detail(f'   {kind}: stack {primary} of {len(members)} assets: {", ".join(members)}')
+
+def repairStacks(immich: Immich, unstack: list, restack: list, workers: int = 1, delay: float = 0.1) -> list:
+  """
+  Take the assets of mismatched stacks out of their stacks, then stack the
+  affected groups again in full. Both phases run through MutationExecutor
+  like the normal apply path. Nothing is restacked after a failed unstack.
+  Returns the failures.
+  """
+  chunk_size = int(os.environ.get("MUTATION_CHUNK_SIZE", 500))
+  executor = MutationExecutor(immich, workers, delay)
+  for i, start in enumerate(range(0, len(unstack), chunk_size)):
+    executor.submit(i, 'unstack', [{"ids": unstack[start:start + chunk_size], "removeParent": True}])
+  failures = executor.close()
+  if failures:
+    logger.error('⛔  Unstacking failed, the groups are not stacked again')
+    return failures
+
+  executor = MutationExecutor(immich, workers, delay)
+  for i, (key, stack) in enumerate(restack):
+    payloads = plan_stack(i, len(restack), key, stack, False)
+    if payloads:
+      executor.submit(i, key, payloads)
+  return executor.close()
+
+
+def report_failures(failures: list) -> None:
+  if not failures:
+    return
+  logger.error(f'🔴  {len(failures)} stacks failed:')
+  for i, key, error in failures:
+    logger.error(f'   {i} Key: {key} {error}')
+
+
+def report_partial_view(error: IncompleteFetchError) -> None:
+  logger.error(f'⛔  Partial view of the library: {error}')
+  logger.error('   Refusing to group or apply changes on incomplete data.')
+  if os.environ.get("FETCH_CHECKPOINT"):
+    logger.error(f'   Fetched pages are kept, the next run resumes from page {error.page}.')
+
+
+def record_changes(changes: ChangeDetector, run_started: float, failures: list) -> None:
+  """
+  Mark the run complete for change detection, unless something is left for
+  a later run: failed mutations, regex timeouts or groups held back without
+  EXIF. Those must be retried even when no asset changes.
+  """
+  if failures or regex_timeouts or exif_held_back:
+    logger.info('⏳  Some assets are left for the next run, which will not skip the fetch')
+    return
+  changes.record(run_started)
 
 def main():
 
@@ -198,54 +2086,257 @@ def main():
 
   dry_run = str2bool(os.environ.get("DRY_RUN", False))
 
-  if not api_key:
+  log_summary = str2bool(os.environ.get("LOG_SUMMARY", False))
+
+  snapshot_load = os.environ.get("SNAPSHOT_LOAD")
+
+  snapshot_save = os.environ.get("SNAPSHOT_SAVE")
+
+  criteria_engine = os.environ.get("CRITERIA_ENGINE", "python").lower()
+
+  criteria_sets = get_criteria_sets()
+
+  pipeline = str2bool(os.environ.get("PIPELINE", False))
+
+  pipeline_window = float(os.environ.get("PIPELINE_WINDOW", 24))
+
+  page_size = int(os.environ.get("PAGE_SIZE", 1000))
+
+  max_group_size = int(os.environ.get("MAX_GROUP_SIZE", 50))
+
+  max_group_action = os.environ.get("MAX_GROUP_ACTION", "warn").lower()
+
+  mutation_workers = int(os.environ.get("MUTATION_WORKERS", 1))
+
+  mutation_delay = float(os.environ.get("MUTATION_DELAY", 0.1))
+
+  exif_criteria = get_exif_criteria_config()
+
+  exif_refine = bool(exif_criteria) or bool(os.environ.get("PARENT_EXIF_PREFER"))
+
+  audit = str2bool(os.environ.get("AUDIT", False))
+
+  audit_fix = str2bool(os.environ.get("AUDIT_FIX", False))
+
+  preflight_size = int(os.environ.get("PREFLIGHT", 0))
+
+  preflight_mode = os.environ.get("PREFLIGHT_MODE", "first").lower()
+
+  preflight_min_match = float(os.environ.get("PREFLIGHT_MIN_MATCH", 0))
+
+  if not api_key and not snapshot_load:
     logger.warn("API key is required")
     return
 
-  logger.info('============== INITIALIZING ==============')
+  # An offline snapshot run changes nothing, so it may overlap a live run
+  run_lock = RunLock.fromEnvironment() if not snapshot_load else RunLock(None)
 
-  if dry_run:
-    logger.info('🔒  Dry run enabled, no changes will be applied')
-  
-  immich = Immich(api_url, api_key)
-  
-  assets = immich.fetchAssets()
+  with queued_logging(), run_lock as lock:
+    if not lock.acquired:
+      holder = lock.holder()
+      started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(holder.get("started", 0)))
+      logger.info(f'⏭️  Previous run (PID {holder.get("pid")}, started {started}) is still in progress, skipping')
+      return
 
-  stacks = stackBy(assets, apply_criteria)
+    # An audit checks the stacks already made, unchanged assets included
+    changes = ChangeDetector.fromEnvironment(api_url, api_key) if not snapshot_load and not audit else None
+    if changes and changes.unchanged():
+      logger.info(f'💤  Nothing added or modified since {changes.since()}, skipping')
+      return
+    run_started = time.time()
 
-  for i, v in enumerate(stacks):
-    key, stack = v
+    logger.info('============== INITIALIZING ==============')
 
-    stack = stratifyStack(stack)
+    if not validate_criteria_regexes(criteria_sets + [("exif", exif_criteria)]):
+      return
+    regex_timeouts.clear()
+    exif_held_back.clear()
+    skipped_oversized.clear()
 
-    parent_id = stack[0]['id']
-    children_id = []
-    
-    if skip_previous:
-      children_id = [x['id'] for x in stack[1:] if x['stackCount'] == None ]
-      
-      if len(children_id) == 0:
-        logger.info(f'{i}/{len(stacks)} Key: {key} SKIP! No new children!')
-        continue
-      
+    if snapshot_load:
+      # A snapshot is an offline view of the library, never act on it
+      dry_run = True
+      logger.info(f'📂  Running offline from snapshot {snapshot_load}')
+
+    if dry_run:
+      logger.info('🔒  Dry run enabled, no changes will be applied')
+
+    if pipeline and len(criteria_sets) > 1:
+      logger.info('⚠️  PIPELINE supports a single criteria set, fetching everything first')
+      pipeline = False
+
+    if pipeline and not pipeline_supported(get_criteria_config()):
+      logger.info('⚠️  PIPELINE needs a plain "localDateTime" criteria, fetching everything first')
+      pipeline = False
+
+    if pipeline and uses_prefix(get_criteria_config()):
+      logger.info('⚠️  PIPELINE cannot resolve "prefix" criteria on partial data, fetching everything first')
+      pipeline = False
+
+    if pipeline and audit:
+      logger.info('⚠️  AUDIT compares every existing stack, fetching everything first')
+      pipeline = False
+
+    if pipeline and exif_refine:
+      logger.info('⚠️  EXIF refinement needs all candidate groups, fetching everything first')
+      pipeline = False
+
+    immich = Immich(api_url, api_key) if not snapshot_load else None
+
+    if preflight_size and immich:
+      logger.info(f'🧪  Checking the criteria on a sample of {preflight_size} assets')
+      try:
+        sample = immich.fetchSample(preflight_size, preflight_mode == 'random')
+      except IncompleteFetchError as e:
+        logger.error(f'⛔  Pre-flight sample could not be fetched: {e}')
+        return
+      problems = preflight(sample, criteria_sets, preflight_min_match)
+      # The full run evaluates these assets again
+      regex_timeouts.clear()
+      if problems:
+        for problem in problems:
+          logger.error(f'⛔  {problem}')
+        logger.error('   Stopping before the full fetch')
+        return
+
+    if pipeline and not snapshot_load:
+      executor = MutationExecutor(immich, mutation_workers, mutation_delay)
+      assets = []
+
+      def pages():
+        logger.info('⬇️  Fetching and stacking assets as they arrive: ')
+        for items in immich.iterPages(page_size, order='asc'):
+          if snapshot_save:
+            assets.extend(items)
+          yield items
+
+      def handle(i, key, stack):
+        payloads = plan_stack(i, '?', key, stack, skip_previous)
+        if payloads and not dry_run:
+          executor.submit(i, key, payloads)
+        return bool(payloads)
+
+      start = time.monotonic()
+      try:
+        # Groups handed over before a failure were closed by the sweep, so
+        # they are complete and safe to stack
+        stacked, total = runPipeline(
+          limitGroups(stackByStream(pages(), apply_criteria, pipeline_window), max_group_size, max_group_action),
+          handle
+        )
+      except IncompleteFetchError as e:
+        report_failures(executor.close())
+        report_partial_view(e)
+        return
+
+      failures = executor.close()
+      log_fetch_metrics(immich.metrics)
+
+      if snapshot_save:
+        saveSnapshot(assets, snapshot_save)
+
+      logger.info(
+        f'✅  Done! Stacks: {stacked} processed, {total - stacked} skipped '
+        f'in {time.monotonic() - start:.1f}s'
+      )
+      report_failures(failures)
+      report_regex_timeouts()
+      if changes and not dry_run:
+        record_changes(changes, run_started, failures)
+      return
+
+    if snapshot_load:
+      assets = loadSnapshot(snapshot_load)
     else:
-      children_id = [x['id'] for x in stack[1:]]
+      try:
+        assets = immich.fetchAssets(page_size)
+      except IncompleteFetchError as e:
+        report_partial_view(e)
+        return
 
-    logger.info(f'{i}/{len(stacks)} Key: {key}')
-    logger.info(f'   Parent name: {stack[0]["originalFileName"]} ID: {parent_id}')
-    
-    for child in stack[1:]:
-      logger.info(f'   Child name:  {child["originalFileName"]} ID: {child["id"]}')
-
-    if len(children_id) > 0:
-      payload = {
-        "ids": children_id,
-        "stackParentId": parent_id
-      }
-
-      if not dry_run:
-        time.sleep(.1)
-        immich.modifyAssets(payload)
+    if snapshot_save:
+      saveSnapshot(assets, snapshot_save)
+
+    key_cache = KeyCache.fromEnvironment()
+
+    stacks = None
+    if len(criteria_sets) > 1:
+      stacks = stackByRuleSets(
+        assets, criteria_sets, columnar=criteria_engine == 'columnar', key_cache=key_cache,
+        max_size=max_group_size, action=max_group_action
+      )
+    elif criteria_engine == 'columnar':
+      stacks = stackByColumnar(assets)
+      if stacks is None:
+        logger.info('⚠️  Columnar engine unavailable for this data, using the Python engine')
+    if stacks is None:
+      resolvePrefixes(assets, get_criteria_config())
+      if key_cache:
+        stacks = stackBy(assets, cachedCriteria(key_cache, criteria_sets[0][0], assets, get_criteria_config()))
+      else:
+        stacks = stackBy(assets, apply_criteria)
+
+    if exif_refine:
+      if immich is None:
+        logger.info('⚠️  EXIF refinement needs the API, skipped when running from a snapshot')
+      else:
+        stacks = refineWithExif(immich, stacks, exif_criteria, skip_previous and not audit)
+
+    log_group_sizes(stacks)
+    if len(criteria_sets) == 1:
+      # Rule sets are limited one by one, before they claim their assets
+      stacks = list(limitGroups(stacks, max_group_size, max_group_action))
+
+    if key_cache:
+      if not os.environ.get("PARENT_EXIF_PREFER"):
+        # EXIF values are fetched afresh every run, so those ranks are not kept
+        parent_ranks.update(key_cache.cached('~parent', [x for _, stack in stacks for x in stack], parent_criteria))
+      evicted = key_cache.evict(x["id"] for x in assets) if immich else 0
+      logger.info(f'🗃️  Key cache: {key_cache.hits} reused, {key_cache.misses} computed, {evicted} evicted')
+      key_cache.close()
+
+    if audit:
+      start = time.monotonic()
+      unknown = exif_held_back + skipped_oversized + [asset_id for asset_id, _, _ in regex_timeouts]
+      mismatches, unstack, restack = auditStacks(assets, stacks, unknown)
+      report_audit(mismatches)
+      failures = []
+      if mismatches and audit_fix and not dry_run:
+        logger.info(f'🔧  Unstacking {len(unstack)} assets and stacking {len(restack)} groups again')
+        failures = repairStacks(immich, unstack, restack, mutation_workers, mutation_delay)
+      elif mismatches and not audit_fix:
+        logger.info('   Set AUDIT_FIX=true to repair them')
+      logger.info(f'✅  Audit done in {time.monotonic() - start:.1f}s')
+      report_failures(failures)
+      return
+
+    executor = MutationExecutor(immich, mutation_workers, mutation_delay) if not dry_run else None
+    progress = Progress(len(stacks)) if log_summary else None
+    stacked = 0
+    start = time.monotonic()
+
+    for i, v in enumerate(stacks):
+      key, stack = v
+
+      payloads = plan_stack(i, len(stacks), key, stack, skip_previous)
+      if payloads:
+        stacked += 1
+        if executor:
+          executor.submit(i, key, payloads)
+
+      if progress:
+        progress.step()
+
+    failures = executor.close() if executor else []
+
+    logger.info(
+      f'✅  Done! Stacks: {stacked} processed, {len(stacks) - stacked} skipped '
+      f'in {time.monotonic() - start:.1f}s'
+    )
+    report_failures(failures)
+    report_regex_timeouts()
+    if changes and not dry_run:
+      record_changes(changes, run_started, failures)
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Benchmark the grouping engines against the reference pipeline and check
+that their output is identical.
+
+  python tests/bench_engines.py --size 200000
+  python tests/bench_engines.py --snapshot library.snapshot
+
+CRITERIA, SKIP_MATCH_MISS and PARENT_PROMOTE are read from the environment
+as usual. Exits with status 1 if any engine differs from the reference.
+"""
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from harness import ENGINES, compare, library_factory
+from immich_auto_stack import loadSnapshot
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100000, help="assets in the generated library")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--snapshot", help="benchmark a library saved with SNAPSHOT_SAVE instead")
+    parser.add_argument("--engine", action="append", choices=sorted(ENGINES), help="engines to run, default all")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    if args.snapshot:
+        assets = loadSnapshot(args.snapshot)
+    else:
+        assets = library_factory(args.size, seed=args.seed)
+    engines = {name: ENGINES[name] for name in (args.engine or ENGINES)}
+
+    print(f"{len(assets)} assets")
+    print(f"{'engine':<10} {'identical':<10} {'seconds':>8} {'speedup':>8}")
+    report = compare(assets, engines)
+    for name, (identical, seconds, speedup) in report.items():
+        print(f"{name:<10} {str(identical):<10} {seconds:>8.2f} {speedup:>7.2f}x")
+
+    return 0 if all(identical for identical, _, _ in report.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
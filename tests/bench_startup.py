@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Measure how long a fresh interpreter takes to import immich_auto_stack, which
+is paid by every cron tick before it can decide there is nothing to do.
+
+  python tests/bench_startup.py --runs 20 --budget 0.1
+
+Reports the median wall time of `python -c "import immich_auto_stack"` next
+to a bare interpreter, and exits with status 1 if the difference exceeds
+--budget seconds.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(code: str, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=root, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget", type=float, default=0.1, help="allowed import time in seconds")
+    args = parser.parse_args()
+
+    bare = measure("pass", args.runs)
+    module = measure("import immich_auto_stack", args.runs)
+    http = measure("import immich_auto_stack; immich_auto_stack.load_http()", args.runs)
+
+    print(f"{'interpreter':<24} {bare:8.3f}s")
+    print(f"{'import':<24} {module - bare:8.3f}s")
+    print(f"{'import + http client':<24} {http - bare:8.3f}s")
+    return 0 if module - bare <= args.budget else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Differential harness: runs the reference stackBy(apply_criteria) +
+stratifyStack pipeline next to the alternative grouping engines and checks
+that they produce the same groups and parents.
+
+Used by test_engine_equivalence.py and bench_engines.py.
+"""
+from datetime import datetime, timedelta
+import os
+import random
+import time
+from unittest.mock import patch
+
+from immich_auto_stack import (
+    apply_criteria,
+    stackBy,
+    stackByColumnar,
+    stackByStream,
+    stratifyStack,
+)
+
+REGEX_CRITERIA = r'[{"key": "originalFileName", "regex": {"key": "([A-Z]+[-_]?[0-9]{4}([-_][0-9]{4})?)([\\._-].*)?\\.[\\w]{3,4}$"}},{"key": "localDateTime"}]'
+
+CRITERIA = {
+    "default": None,
+    "regex": REGEX_CRITERIA,
+    "date": '[{"key": "originalFileName", "split": {"key": ".", "index": 0}}, {"key": "localDateTime", "split": {"key": "T", "index": 0}}]',
+    "thumbhash": '[{"key": "thumbhash"}, {"key": "localDateTime"}]',
+    # The optional group is None for names without the IMG prefix, a key that contains None
+    "optional": r'[{"key": "originalFileName", "regex": {"key": "(IMG)?_([0-9]{4})", "index": 1}}, {"key": "localDateTime"}]',
+}
+
+
+def library_factory(size: int, seed: int = 0) -> list:
+    """
+    Generate a library of roughly `size` assets sorted by fileCreatedAt, the
+    way the pipeline fetches them. It mixes RAW+JPG pairs, edits, bursts
+    sharing a timestamp, filenames the regex criteria does not match, names
+    without a prefix and assets without a thumbhash.
+    """
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1)
+    assets = []
+    while len(assets) < size:
+        created = start + timedelta(seconds=rng.randrange(3 * 365 * 24 * 3600))
+        local = created + timedelta(hours=rng.randint(-12, 14))
+        prefix = rng.choice(["IMG_", "DSCF", "IMG-", "_", "Screenshot "])
+        number = rng.randrange(10000)
+        if prefix == "Screenshot ":
+            names = [f"Screenshot {number}.png"]
+        else:
+            names = [f"{prefix}{number:04d}.{ext}" for ext in rng.sample(["JPG", "CR2", "RAF", "heic"], rng.randint(1, 3))]
+            if rng.random() < 0.2:
+                names.append(f"{prefix}{number:04d}_edit.jpg")
+        for name in names:
+            assets.append({
+                "id": f"{len(assets):08d}",
+                "originalFileName": name,
+                "fileCreatedAt": created.isoformat() + ".000Z",
+                "localDateTime": local.isoformat() + ".000Z",
+                "thumbhash": rng.choice([None, "hash-a", "hash-b", f"hash-{number}"]),
+                "stackCount": None,
+            })
+    assets.sort(key=lambda x: (x["fileCreatedAt"], x["id"]))
+    return assets
+
+
+def reference_engine(assets: list) -> list:
+    return stackBy(assets, apply_criteria)
+
+
+def spill_engine(assets: list) -> list:
+    with patch.dict(os.environ, {"MEMORY_BUDGET": "1"}):
+        return stackBy(assets, apply_criteria)
+
+
+def columnar_engine(assets: list) -> list:
+    groups = stackByColumnar(assets)
+    if groups is None:
+        raise NotImplementedError("columnar engine unavailable")
+    return groups
+
+
+def stream_engine(assets: list) -> list:
+    pages = [assets[i:i + 1000] for i in range(0, len(assets), 1000)]
+    return list(stackByStream(pages, apply_criteria))
+
+
+ENGINES = {
+    "spill": spill_engine,
+    "columnar": columnar_engine,
+    "stream": stream_engine,
+}
+
+# Engines that only support some criteria
+ENGINE_CRITERIA = {
+    "stream": {"default", "regex", "thumbhash", "optional"},
+}
+
+
+def normalize(groups: list) -> list:
+    """
+    Order-insensitive view of a grouping: key, parent id and member ids.
+    """
+    result = []
+    for key, stack in groups:
+        stack = stratifyStack(stack)
+        result.append((repr(key), stack[0]["id"], sorted(x["id"] for x in stack)))
+    return sorted(result)
+
+
+def run(engine, assets: list) -> tuple:
+    """
+    Return (normalized groups or the raised error message, seconds).
+    """
+    start = time.perf_counter()
+    try:
+        groups = engine(assets)
+    except NotImplementedError:
+        raise
+    except Exception as e:
+        return f"{type(e).__name__}: {e}", time.perf_counter() - start
+    seconds = time.perf_counter() - start
+    return normalize(groups), seconds
+
+
+def compare(assets: list, engines: dict = ENGINES) -> dict:
+    """
+    Run the reference and every engine over `assets` with the current
+    environment. Returns {name: (identical, seconds, speedup)}, the reference
+    included under "reference". Each engine is warmed up on a small sample
+    first so lazy imports are not timed.
+    """
+    for engine in engines.values():
+        try:
+            engine(assets[:100])
+        except Exception:
+            pass
+    expected, reference_seconds = run(reference_engine, assets)
+    report = {"reference": (True, reference_seconds, 1.0)}
+    for name, engine in engines.items():
+        try:
+            result, seconds = run(engine, assets)
+        except NotImplementedError:
+            continue
+        report[name] = (result == expected, seconds, reference_seconds / max(seconds, 1e-9))
+    return report
@@ -0,0 +1,99 @@
+import os
+from unittest.mock import Mock, patch
+
+from immich_auto_stack import KeyCache, apply_criteria, cachedCriteria, stackBy
+
+
+def asset_factory(asset_id, filename, updated="2024-05-01T10:00:00.000Z"):
+    return {
+        "id": asset_id,
+        "originalFileName": filename,
+        "localDateTime": "2024-05-01T10:00:00.000Z",
+        "updatedAt": updated,
+    }
+
+
+def test_KeyCache_only_computes_new_or_modified_assets(tmp_path):
+    # Arrange
+    path = str(tmp_path / "keys.db")
+    assets = [asset_factory("a", "IMG_1.jpg"), asset_factory("b", "IMG_2.jpg")]
+    KeyCache(path).cached("default", assets, apply_criteria)
+    assets = [
+        asset_factory("a", "IMG_1.jpg"),
+        asset_factory("b", "IMG_2.jpg", updated="2024-06-01T10:00:00.000Z"),
+        asset_factory("c", "IMG_3.jpg"),
+    ]
+    compute = Mock(side_effect=apply_criteria)
+    key_cache = KeyCache(path)
+
+    # Act
+    result = key_cache.cached("default", assets, compute)
+
+    # Assert
+    assert [call.args[0]["id"] for call in compute.call_args_list] == ["b", "c"]
+    assert result == {x["id"]: apply_criteria(x) for x in assets}
+    assert (key_cache.hits, key_cache.misses) == (1, 2)
+
+
+def test_KeyCache_is_dropped_when_the_criteria_change(tmp_path):
+    # Arrange
+    path = str(tmp_path / "keys.db")
+    assets = [asset_factory("a", "IMG_1.jpg")]
+    KeyCache(path).cached("default", assets, apply_criteria)
+    compute = Mock(side_effect=apply_criteria)
+
+    # Act
+    with patch.dict(os.environ, {"CRITERIA": '[{"key": "originalFileName"}]'}):
+        KeyCache(path).cached("default", assets, compute)
+
+    # Assert
+    assert compute.call_count == 1
+
+
+def test_KeyCache_keeps_criteria_sets_apart(tmp_path):
+    # Arrange
+    key_cache = KeyCache(str(tmp_path / "keys.db"))
+    assets = [asset_factory("a", "IMG_1.jpg")]
+    key_cache.cached("first", assets, lambda x: ["first"])
+
+    # Act
+    result = key_cache.cached("second", assets, lambda x: ["second"])
+
+    # Assert
+    assert result == {"a": ["second"]}
+
+
+def test_KeyCache_evicts_assets_no_longer_in_the_library(tmp_path):
+    # Arrange
+    path = str(tmp_path / "keys.db")
+    key_cache = KeyCache(path)
+    assets = [asset_factory("a", "IMG_1.jpg"), asset_factory("b", "IMG_2.jpg")]
+    key_cache.cached("default", assets, apply_criteria)
+
+    # Act
+    removed = key_cache.evict(["a"])
+    compute = Mock(side_effect=apply_criteria)
+    key_cache.cached("default", assets, compute)
+
+    # Assert
+    assert removed == 1
+    assert [call.args[0]["id"] for call in compute.call_args_list] == ["b"]
+
+
+def test_cachedCriteria_groups_like_apply_criteria(tmp_path):
+    # Arrange
+    key_cache = KeyCache(str(tmp_path / "keys.db"))
+    assets = [
+        asset_factory("raw", "IMG_1.CR2"),
+        asset_factory("jpg", "IMG_1.jpg"),
+        asset_factory("other", "IMG_2.jpg"),
+    ]
+    config = [{"key": "originalFileName", "split": {"key": ".", "index": 0}}, {"key": "localDateTime"}]
+
+    # Act
+    cachedCriteria(key_cache, "default", assets, config)
+    result = stackBy(assets, cachedCriteria(key_cache, "default", assets, config))
+
+    # Assert
+    assert result == stackBy(assets, apply_criteria)
+    assert key_cache.hits == 3
@@ -0,0 +1,104 @@
+import pytest
+import threading
+import time
+from unittest.mock import Mock, patch
+
+from immich_auto_stack import Immich, MutationExecutor
+
+
+def payloads_factory(i, count=1):
+    return [{"ids": [f"{i}-child-{n}"], "stackParentId": f"{i}-parent"} for n in range(count)]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_MutationExecutor_sends_every_payload(workers):
+    # Arrange
+    immich = Mock()
+    immich.pool_size = 10
+    executor = MutationExecutor(immich, workers=workers, delay=0)
+
+    # Act
+    for i in range(20):
+        executor.submit(i, f"key-{i}", payloads_factory(i, count=2))
+    failures = executor.close()
+
+    # Assert
+    assert failures == []
+    assert immich.modifyAssets.call_count == 40
+
+
+def test_MutationExecutor_bounds_requests_in_flight():
+    # Arrange
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def modifyAssets(payload):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight -= 1
+        return True
+
+    immich = Mock()
+    immich.modifyAssets.side_effect = modifyAssets
+    immich.pool_size = 10
+    executor = MutationExecutor(immich, workers=3, delay=0)
+
+    # Act
+    for i in range(30):
+        executor.submit(i, f"key-{i}", payloads_factory(i))
+    executor.close()
+
+    # Assert
+    assert 1 < max_in_flight <= 3
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_MutationExecutor_collects_failures_in_stack_order(workers):
+    # Arrange
+    def modifyAssets(payload):
+        i = int(payload["stackParentId"].split("-")[0])
+        if i % 5 == 0:
+            raise ConnectionError("refused")
+        return i % 3 != 0
+
+    immich = Mock()
+    immich.modifyAssets.side_effect = modifyAssets
+    immich.pool_size = 10
+    executor = MutationExecutor(immich, workers=workers, delay=0)
+
+    # Act
+    for i in range(1, 16):
+        executor.submit(i, f"key-{i}", payloads_factory(i))
+    failures = executor.close()
+
+    # Assert
+    assert failures == [
+        (3, "key-3", "request failed"),
+        (5, "key-5", "ConnectionError: refused"),
+        (6, "key-6", "request failed"),
+        (9, "key-9", "request failed"),
+        (10, "key-10", "ConnectionError: refused"),
+        (12, "key-12", "request failed"),
+        (15, "key-15", "ConnectionError: refused"),
+    ]
+
+
+@patch("immich_auto_stack.Session")
+def test_MutationExecutor_grows_the_pool_of_an_existing_session(mock_session_class):
+    # Arrange
+    immich = Immich("http://immich", "key")
+    session = immich.getSession()
+    session.mount.reset_mock()
+
+    # Act
+    MutationExecutor(immich, workers=16, delay=0).close()
+
+    # Assert
+    assert immich.pool_size == 16
+    adapters = [call.args[1] for call in session.mount.call_args_list]
+    assert [adapter._pool_maxsize for adapter in adapters] == [16, 16]
@@ -0,0 +1,164 @@
+import json
+import os
+import pytest
+import time
+from unittest.mock import patch
+
+from immich_auto_stack import RunLock, main
+
+
+@pytest.fixture(params=["flock", "lockfile"])
+def lock_mode(request):
+    if request.param == "lockfile":
+        with patch("immich_auto_stack.fcntl", None):
+            yield request.param
+    else:
+        pytest.importorskip("fcntl")
+        yield request.param
+
+
+def test_RunLock_allows_a_single_holder(lock_mode, tmp_path):
+    # Arrange
+    path = str(tmp_path / "run.lock")
+
+    # Act
+    with RunLock(path) as first:
+        with RunLock(path) as second:
+            second_acquired = second.acquired
+        holder = first.holder()
+    with RunLock(path) as third:
+        third_acquired = third.acquired
+
+    # Assert
+    assert first.acquired
+    assert not second_acquired
+    assert holder["pid"] == os.getpid()
+    assert third_acquired
+
+
+def test_RunLock_waits_for_the_holder_up_to_the_limit(lock_mode, tmp_path):
+    # Arrange
+    path = str(tmp_path / "run.lock")
+
+    # Act
+    with RunLock(path):
+        start = time.monotonic()
+        with RunLock(path, wait=0.3) as second:
+            waited = time.monotonic() - start
+
+    # Assert
+    assert not second.acquired
+    assert waited >= 0.3
+
+
+@pytest.mark.parametrize(
+    "holder",
+    [
+        {"pid": 2**22 + 1, "started": 0, "heartbeat": time.time() - 900},  # crashed run
+        {"pid": os.getpid(), "started": 0, "heartbeat": 0},  # no heartbeat
+    ],
+)
+def test_RunLock_recovers_stale_lockfiles(tmp_path, holder):
+    # Arrange
+    path = tmp_path / "run.lock"
+    path.write_text(json.dumps(holder))
+
+    # Act
+    with patch("immich_auto_stack.fcntl", None):
+        with RunLock(str(path), stale_seconds=600) as lock:
+            acquired = lock.acquired
+
+    # Assert
+    assert acquired
+    assert not path.exists()
+
+
+def test_RunLock_fallback_keeps_lockfiles_with_a_fresh_heartbeat(tmp_path):
+    # Arrange
+    path = tmp_path / "run.lock"
+    path.write_text(json.dumps({"pid": 2**22 + 1, "started": 0, "heartbeat": time.time()}))
+
+    # Act
+    with patch("immich_auto_stack.fcntl", None), patch("immich_auto_stack.os.kill") as mock_kill:
+        with RunLock(str(path), stale_seconds=600) as lock:
+            acquired = lock.acquired
+
+    # Assert
+    assert not acquired
+    assert path.exists()
+    mock_kill.assert_not_called()
+
+
+def test_RunLock_takeover_never_leaves_the_lockfile_missing(tmp_path):
+    # Arrange
+    path = tmp_path / "run.lock"
+    path.write_text(json.dumps({"pid": 2**22 + 1, "started": 0, "heartbeat": 0}))
+
+    # Act
+    with patch("immich_auto_stack.fcntl", None), patch("immich_auto_stack.os.remove") as mock_remove:
+        lock = RunLock(str(path))
+        acquired = lock.acquire()
+        holder = lock.holder()
+        lock.stopped.set()
+        os.close(lock.fd)
+
+    # Assert
+    assert acquired
+    assert holder["token"] == lock.token
+    assert str(path) not in [call.args[0] for call in mock_remove.call_args_list]
+    assert sorted(os.listdir(tmp_path)) == ["run.lock"]
+
+
+def test_RunLock_takeover_backs_off_when_another_run_wins(tmp_path):
+    # Arrange
+    path = tmp_path / "run.lock"
+    path.write_text(json.dumps({"pid": 2**22 + 1, "started": 0, "heartbeat": 0}))
+    first = RunLock(str(path))
+    second = RunLock(str(path))
+    stale = first.holder()
+
+    def settle(seconds):
+        # The second run found the same lock stale and renames its own over it meanwhile
+        replacement = tmp_path / "second.lock"
+        replacement.write_bytes(second._content())
+        os.replace(replacement, path)
+
+    # Act
+    with patch("immich_auto_stack.fcntl", None), patch("immich_auto_stack.time.sleep", side_effect=settle):
+        acquired = first._takeOver(stale)
+
+    # Assert
+    assert not acquired
+    assert first.fd is None
+    assert first.holder()["token"] == second.token
+
+
+@patch("immich_auto_stack.Immich")
+def test_main_skips_the_tick_while_a_run_holds_the_lock(mock_immich_class, tmp_path):
+    # Arrange
+    path = str(tmp_path / "run.lock")
+    test_environ = {"API_KEY": "123", "API_URL": "456", "LOCK_FILE": path}
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        with RunLock(path):
+            main()
+
+    # Assert
+    assert mock_immich_class.call_count == 0
+
+
+@patch("immich_auto_stack.loadSnapshot")
+def test_main_takes_no_lock_from_a_snapshot(mock_loadSnapshot, tmp_path):
+    # Arrange
+    path = str(tmp_path / "run.lock")
+    mock_loadSnapshot.return_value = []
+    test_environ = {"SNAPSHOT_LOAD": str(tmp_path / "library.snapshot"), "LOCK_FILE": path}
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        with RunLock(path):
+            main()
+
+    # Assert
+    mock_loadSnapshot.assert_called_once()
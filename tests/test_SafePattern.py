@@ -0,0 +1,140 @@
+import logging
+import os
+import re
+import time
+import pytest
+from unittest.mock import patch
+
+from immich_auto_stack import (
+    RegexTimeout,
+    SafePattern,
+    apply_criteria,
+    regex_timeouts,
+    safe_patterns,
+    validate_criteria_regexes,
+)
+
+# Backtracks exponentially on a run of "a" that fails to match at the end,
+# in the standard re engine and in the regex module alike
+catastrophic = r"(a|aa)+$"
+adversarial = "a" * 40 + "!"
+
+
+@pytest.fixture(autouse=True)
+def fresh_patterns():
+    safe_patterns.clear()
+    regex_timeouts.clear()
+    yield
+    safe_patterns.clear()
+    regex_timeouts.clear()
+
+
+def standard_re(pattern, timeout):
+    safe_pattern = SafePattern(pattern, timeout)
+    safe_pattern.engine = "re"
+    safe_pattern.compiled = re.compile(pattern)
+    return safe_pattern
+
+
+def test_SafePattern_stops_a_backtracking_match_on_the_standard_engine():
+    # Arrange
+    safe_pattern = standard_re(catastrophic, 0.1)
+
+    # Act
+    start = time.monotonic()
+    with pytest.raises(RegexTimeout):
+        safe_pattern.match(adversarial)
+
+    # Assert
+    assert time.monotonic() - start < 2
+
+
+def test_SafePattern_matches_like_re_within_the_budget():
+    # Arrange
+    pattern = r"([A-Z]+[-_]?[0-9]{4})([\._-].*)?\.[\w]{3,4}$"
+    safe_pattern = SafePattern(pattern, 0.5)
+
+    # Act
+    match = safe_pattern.match("IMG_1234_edit.jpg")
+
+    # Assert
+    assert match.group(1) == re.match(pattern, "IMG_1234_edit.jpg").group(1)
+
+
+def test_SafePattern_prefers_re2():
+    # Arrange
+    pytest.importorskip("re2")
+
+    # Act
+    safe_pattern = SafePattern(catastrophic, 0.1)
+
+    # Assert
+    assert safe_pattern.engine == "re2"
+    assert safe_pattern.match(adversarial) is None
+
+
+def test_SafePattern_falls_back_when_re2_does_not_support_the_pattern():
+    # Arrange
+    pytest.importorskip("re2")
+
+    # Act
+    safe_pattern = SafePattern(r"(\w)\1", 0.1)
+
+    # Assert
+    assert safe_pattern.engine != "re2"
+    assert safe_pattern.match("aa").group(1) == "a"
+
+
+def test_SafePattern_uses_the_timeout_of_the_regex_module():
+    # Arrange
+    regex = pytest.importorskip("regex")
+    safe_pattern = SafePattern(catastrophic, 0.1)
+    safe_pattern.engine = "regex"
+    safe_pattern.compiled = regex.compile(catastrophic)
+
+    # Act & Assert
+    with pytest.raises(RegexTimeout):
+        safe_pattern.match(adversarial)
+
+
+def test_apply_criteria_skips_and_records_assets_that_run_out_of_time():
+    # Arrange
+    criteria = '[{"key": "originalFileName", "regex": {"key": "%s", "index": 1}}]' % catastrophic.replace("\\", "\\\\")
+    safe_patterns[(catastrophic, 0.1)] = standard_re(catastrophic, 0.1)
+    asset = {"id": "slow", "originalFileName": adversarial}
+
+    # Act
+    with patch.dict(os.environ, {"CRITERIA": criteria, "REGEX_SAFE": "true", "REGEX_TIMEOUT": "0.1"}):
+        result = apply_criteria(asset)
+
+    # Assert
+    assert result == []
+    assert regex_timeouts == [("slow", adversarial, catastrophic)]
+
+
+def test_validate_criteria_regexes_rejects_invalid_patterns(caplog):
+    # Arrange
+    criteria_sets = [("default", [{"key": "originalFileName", "regex": {"key": "(IMG_[0-9"}}])]
+
+    # Act
+    result = validate_criteria_regexes(criteria_sets)
+
+    # Assert
+    assert result is False
+    assert "Invalid CRITERIA regex" in caplog.text
+
+
+def test_validate_criteria_regexes_warns_about_nested_quantifiers(caplog):
+    # Arrange
+    criteria_sets = [("default", [{"key": "originalFileName", "regex": {"key": r"(\w+_?)+\.jpg"}}])]
+    caplog.set_level(logging.INFO)
+
+    # Act
+    with patch.dict(os.environ, {"REGEX_SAFE": "true"}), patch(
+        "immich_auto_stack.get_safe_pattern", side_effect=lambda pattern: standard_re(pattern, 0.5)
+    ):
+        result = validate_criteria_regexes(criteria_sets)
+
+    # Assert
+    assert result is True
+    assert "nested quantifier" in caplog.text
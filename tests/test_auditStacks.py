@@ -0,0 +1,231 @@
+import os
+from unittest.mock import Mock, patch
+
+from immich_auto_stack import ChangeDetector, auditStacks, exif_held_back, main, refineWithExif, repairStacks
+
+
+def asset_factory(asset_id, filename, stack_parent=None):
+    return {
+        "id": asset_id,
+        "originalFileName": filename,
+        "localDateTime": "2024-05-01T10:00:00.000Z",
+        "stackParentId": stack_parent,
+        "stackCount": 2 if stack_parent else None,
+    }
+
+
+def test_auditStacks_accepts_stacks_that_match_the_groups():
+    # Arrange
+    jpg = asset_factory("jpg", "IMG_1.jpg", "jpg")
+    raw = asset_factory("raw", "IMG_1.CR2", "jpg")
+    groups = [(["IMG_1"], [raw, jpg])]
+
+    # Act
+    mismatches, unstack, restack = auditStacks([jpg, raw], groups)
+
+    # Assert
+    assert (mismatches, unstack, restack) == ([], [], [])
+
+
+def test_auditStacks_finds_stacks_of_unrelated_assets():
+    # Arrange
+    jpg = asset_factory("jpg", "IMG_1.jpg", "jpg")
+    other = asset_factory("other", "IMG_2.CR2", "jpg")
+    raw = asset_factory("raw", "IMG_1.CR2")
+    groups = [(["IMG_1"], [jpg, raw])]
+
+    # Act
+    mismatches, unstack, restack = auditStacks([jpg, other, raw], groups)
+
+    # Assert
+    assert mismatches == [("split", "jpg", ["jpg", "other"])]
+    assert sorted(unstack) == ["jpg", "other"]
+    assert restack == groups
+
+
+def test_auditStacks_finds_stacks_with_the_wrong_parent():
+    # Arrange
+    jpg = asset_factory("jpg", "IMG_1.jpg", "raw")
+    raw = asset_factory("raw", "IMG_1.CR2", "raw")
+    groups = [(["IMG_1"], [jpg, raw])]
+
+    # Act
+    mismatches, unstack, restack = auditStacks([jpg, raw], groups)
+
+    # Assert
+    assert mismatches == [("parent", "raw", ["jpg", "raw"])]
+    assert restack == groups
+
+
+def test_auditStacks_finds_groups_spread_over_several_stacks():
+    # Arrange
+    assets = [
+        asset_factory("jpg", "IMG_1.jpg", "jpg"),
+        asset_factory("jpg-edit", "IMG_1.jpeg", "jpg"),
+        asset_factory("raw", "IMG_1.CR2", "raw"),
+        asset_factory("tif", "IMG_1.tif", "raw"),
+    ]
+    groups = [(["IMG_1"], assets)]
+
+    # Act
+    mismatches, unstack, restack = auditStacks(assets, groups)
+
+    # Assert
+    assert [kind for kind, _, _ in mismatches] == ["merge", "merge"]
+    assert sorted(unstack) == ["jpg", "jpg-edit", "raw", "tif"]
+    assert restack == groups
+
+
+def test_auditStacks_reads_the_stack_object_of_newer_servers():
+    # Arrange
+    jpg = {"id": "jpg", "originalFileName": "IMG_1.jpg", "stack": {"primaryAssetId": "jpg"}}
+    other = {"id": "other", "originalFileName": "IMG_2.CR2", "stack": {"primaryAssetId": "jpg"}}
+
+    # Act
+    mismatches, unstack, restack = auditStacks([jpg, other], [])
+
+    # Assert
+    assert mismatches == [("split", "jpg", ["jpg", "other"])]
+    assert restack == []
+
+
+def test_auditStacks_leaves_out_stacks_of_assets_held_back_without_exif():
+    # Arrange
+    jpg = asset_factory("jpg", "IMG_1.jpg", "jpg")
+    raw = asset_factory("raw", "IMG_1.CR2", "jpg")
+    immich = Mock()
+    immich.fetchExif.return_value = {}
+    exif_held_back.clear()
+    groups = refineWithExif(immich, [(["IMG_1"], [jpg, raw])], [{"key": "model"}])
+
+    # Act
+    mismatches, unstack, restack = auditStacks([jpg, raw], groups, exif_held_back)
+
+    # Assert
+    assert groups == []
+    assert (mismatches, unstack, restack) == ([], [], [])
+
+
+def test_auditStacks_leaves_out_stacks_sharing_a_group_with_unknown_assets():
+    # Arrange
+    assets = [
+        asset_factory("jpg", "IMG_1.jpg", "jpg"),
+        asset_factory("timed-out", "IMG_1.jpeg", "jpg"),
+        asset_factory("raw", "IMG_1.CR2", "raw"),
+        asset_factory("tif", "IMG_1.tif", "raw"),
+        asset_factory("other", "IMG_2.jpg", "other"),
+        asset_factory("unrelated", "IMG_3.jpg", "other"),
+    ]
+    groups = [(["IMG_1"], [assets[0], assets[2], assets[3]])]
+
+    # Act
+    mismatches, unstack, restack = auditStacks(assets, groups, ["timed-out"])
+
+    # Assert
+    assert mismatches == [("split", "other", ["other", "unrelated"])]
+    assert sorted(unstack) == ["other", "unrelated"]
+    assert restack == []
+
+
+def test_repairStacks_unstacks_before_restacking():
+    # Arrange
+    immich = Mock()
+    immich.pool_size = 10
+    jpg = asset_factory("jpg", "IMG_1.jpg")
+    raw = asset_factory("raw", "IMG_1.CR2")
+
+    # Act
+    with patch.dict(os.environ, {"MUTATION_CHUNK_SIZE": "1"}):
+        failures = repairStacks(immich, ["jpg", "other"], [(["IMG_1"], [raw, jpg])], delay=0)
+
+    # Assert
+    assert failures == []
+    assert [call.args[0] for call in immich.modifyAssets.call_args_list] == [
+        {"ids": ["jpg"], "removeParent": True},
+        {"ids": ["other"], "removeParent": True},
+        {"ids": ["raw"], "stackParentId": "jpg"},
+    ]
+
+
+def test_repairStacks_does_not_restack_after_a_failed_unstack():
+    # Arrange
+    immich = Mock()
+    immich.pool_size = 10
+    immich.modifyAssets.return_value = False
+
+    # Act
+    failures = repairStacks(immich, ["jpg"], [(["IMG_1"], [asset_factory("jpg", "IMG_1.jpg")])], delay=0)
+
+    # Assert
+    assert len(failures) == 1
+    assert immich.modifyAssets.call_count == 1
+
+
+@patch("immich_auto_stack.Immich")
+def test_main_audit_reports_without_the_normal_apply(mock_immich_class, tmp_path):
+    # Arrange
+    mock_immich_class().fetchAssets.return_value = [
+        asset_factory("jpg", "IMG_1.jpg", "jpg"),
+        asset_factory("other", "IMG_2.CR2", "jpg"),
+        asset_factory("raw", "IMG_1.CR2"),
+    ]
+    test_environ = {"API_KEY": "123", "API_URL": "http://immich", "AUDIT": "true", "LOCK_FILE": str(tmp_path / "lock")}
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        main()
+
+    # Assert
+    mock_immich_class().modifyAssets.assert_not_called()
+
+
+@patch("immich_auto_stack.Immich")
+def test_main_audit_runs_on_an_unchanged_library(mock_immich_class, tmp_path):
+    # Arrange
+    mock_immich_class().fetchAssets.return_value = [
+        asset_factory("jpg", "IMG_1.jpg", "jpg"),
+        asset_factory("other", "IMG_2.CR2", "jpg"),
+    ]
+    test_environ = {
+        "API_KEY": "123",
+        "API_URL": "http://immich",
+        "AUDIT": "true",
+        "CHANGE_DETECTION": "true",
+        "CHANGE_STATE_FILE": str(tmp_path / "state.json"),
+        "LOCK_FILE": str(tmp_path / "lock"),
+    }
+    with patch.dict(os.environ, test_environ):
+        ChangeDetector(test_environ["CHANGE_STATE_FILE"], test_environ["API_URL"], "123").record(1700000000)
+
+        # Act
+        with patch("urllib.request.urlopen") as mock_urlopen:
+            main()
+
+    # Assert
+    mock_urlopen.assert_not_called()
+    mock_immich_class().fetchAssets.assert_called_once()
+
+
+@patch("immich_auto_stack.Immich")
+def test_main_audit_fix_keeps_stacks_whose_exif_could_not_be_fetched(mock_immich_class, tmp_path):
+    # Arrange
+    mock_immich_class().fetchAssets.return_value = [
+        asset_factory("jpg", "IMG_1.jpg", "jpg"),
+        asset_factory("raw", "IMG_1.CR2", "jpg"),
+    ]
+    mock_immich_class().fetchExif.return_value = {}
+    test_environ = {
+        "API_KEY": "123",
+        "API_URL": "http://immich",
+        "AUDIT": "true",
+        "AUDIT_FIX": "true",
+        "EXIF_CRITERIA": '[{"key": "model"}]',
+        "LOCK_FILE": str(tmp_path / "lock"),
+    }
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        main()
+
+    # Assert
+    mock_immich_class().modifyAssets.assert_not_called()
@@ -27,6 +27,7 @@ def test_main_applies_dry_run_env_var_to_skip_modifyAssets(
     mock_stratifyStack,
     dry_run_env_var,
     expected_call_count,
+    tmp_path,
 ):
     # Arrange
     # mock the function calls within main() to create predictable scenarios
@@ -46,6 +47,7 @@ def test_main_applies_dry_run_env_var_to_skip_modifyAssets(
     test_environ = {
         "API_KEY": "123",
         "API_URL": "456",
+        "LOCK_FILE": str(tmp_path / "run.lock"),
     }
     if dry_run_env_var is not None:
         test_environ["DRY_RUN"] = dry_run_env_var
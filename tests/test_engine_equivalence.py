@@ -0,0 +1,43 @@
+import os
+import pytest
+from unittest.mock import patch
+
+from harness import CRITERIA, ENGINE_CRITERIA, ENGINES, library_factory, normalize, run, reference_engine
+
+
+@pytest.mark.parametrize("engine_name", sorted(ENGINES))
+@pytest.mark.parametrize("criteria_name", sorted(CRITERIA))
+@pytest.mark.parametrize("is_skip_match_miss", [True, False])
+def test_engine_matches_reference_pipeline(engine_name, criteria_name, is_skip_match_miss):
+    # Arrange
+    if criteria_name not in ENGINE_CRITERIA.get(engine_name, CRITERIA):
+        pytest.skip(f"{engine_name} does not support the {criteria_name} criteria")
+    if engine_name == "columnar":
+        pytest.importorskip("pandas")
+    assets = library_factory(3000, seed=sorted(CRITERIA).index(criteria_name))
+    test_environ = {"SKIP_MATCH_MISS": str(is_skip_match_miss)}
+    if CRITERIA[criteria_name]:
+        test_environ["CRITERIA"] = CRITERIA[criteria_name]
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        expected_result, _ = run(reference_engine, assets)
+        result, _ = run(ENGINES[engine_name], assets)
+
+    # Assert
+    assert result == expected_result
+
+
+def test_library_factory_covers_edge_cases():
+    # Arrange
+    assets = library_factory(3000)
+
+    # Act
+    with patch.dict(os.environ, {"CRITERIA": CRITERIA["regex"], "SKIP_MATCH_MISS": "True"}):
+        groups = normalize(reference_engine(assets))
+
+    # Assert
+    assert any(x["thumbhash"] is None for x in assets)
+    assert any(x["originalFileName"].startswith("Screenshot") for x in assets)
+    assert any(x["originalFileName"].startswith("_") for x in assets)
+    assert any(len(members) > 2 for _, _, members in groups)
@@ -0,0 +1,207 @@
+import os
+import pytest
+from unittest.mock import Mock, patch
+
+from requests import ConnectionError
+
+from immich_auto_stack import Immich, IncompleteFetchError, PageSizer, main
+
+
+def response_factory(page, next_page, status_code=200):
+    response = Mock()
+    response.ok = status_code < 400
+    response.status_code = status_code
+    response.text = "error" if status_code >= 400 else ""
+    response.content = b"{}"
+    response.json.return_value = {
+        "assets": {
+            "items": [{"id": f"{page}-{i}"} for i in range(2)],
+            "nextPage": next_page,
+        }
+    }
+    return response
+
+
+def ids(assets):
+    return [x["id"] for x in assets]
+
+
+@patch("immich_auto_stack.time.sleep")
+@patch("immich_auto_stack.Session")
+def test_fetchAssets_retries_a_failed_page(mock_session_class, mock_sleep):
+    # Arrange
+    mock_session_class().post.side_effect = [
+        response_factory(1, 2),
+        response_factory(2, None, status_code=502),
+        ConnectionError(),
+        response_factory(2, None),
+    ]
+    immich = Immich("http://immich", "key")
+
+    # Act
+    result = immich.fetchAssets(size=2)
+
+    # Assert
+    assert ids(result) == ["1-0", "1-1", "2-0", "2-1"]
+    assert mock_sleep.call_count == 2
+
+
+@patch("immich_auto_stack.time.sleep")
+@patch("immich_auto_stack.Session")
+def test_fetchAssets_raises_instead_of_returning_a_partial_view(mock_session_class, mock_sleep):
+    # Arrange
+    mock_session_class().post.side_effect = [response_factory(1, 2)] + [
+        response_factory(2, None, status_code=502)
+    ] * 3
+    immich = Immich("http://immich", "key")
+
+    # Act
+    # Assert
+    with patch.dict(os.environ, {"FETCH_RETRIES": "2"}):
+        with pytest.raises(IncompleteFetchError) as execinfo:
+            immich.fetchAssets(size=2)
+    assert execinfo.value.page == 2
+
+
+@patch("immich_auto_stack.time.sleep")
+@patch("immich_auto_stack.Session")
+def test_fetchAssets_does_not_retry_client_errors(mock_session_class, mock_sleep):
+    # Arrange
+    mock_session_class().post.side_effect = [response_factory(1, None, status_code=401)]
+    immich = Immich("http://immich", "key")
+
+    # Act
+    # Assert
+    with pytest.raises(IncompleteFetchError):
+        immich.fetchAssets(size=2)
+    assert mock_sleep.call_count == 0
+
+
+@patch("immich_auto_stack.time.sleep")
+@patch("immich_auto_stack.Session")
+def test_fetchAssets_resumes_from_the_failed_page_with_a_checkpoint(
+    mock_session_class, mock_sleep, tmp_path
+):
+    # Arrange
+    checkpoint = str(tmp_path / "fetch.checkpoint")
+    mock_session_class().post.side_effect = [
+        response_factory(1, 2),
+        response_factory(2, 3),
+        response_factory(3, None, status_code=502),
+        response_factory(3, None),
+    ]
+    immich = Immich("http://immich", "key")
+    test_environ = {"FETCH_CHECKPOINT": checkpoint, "FETCH_RETRIES": "0"}
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        with pytest.raises(IncompleteFetchError):
+            immich.fetchAssets(size=2)
+        result = immich.fetchAssets(size=2)
+
+    # Assert
+    assert ids(result) == ["1-0", "1-1", "2-0", "2-1", "3-0", "3-1"]
+    assert mock_session_class().post.call_count == 4
+    assert not os.path.exists(checkpoint)
+
+
+@patch("immich_auto_stack.stackBy")
+@patch("immich_auto_stack.Immich")
+def test_main_refuses_to_act_on_a_partial_view(mock_immich_class, mock_stackBy, tmp_path):
+    # Arrange
+    mock_immich_class().fetchAssets.side_effect = IncompleteFetchError(3, 2, "502")
+    test_environ = {"API_KEY": "123", "API_URL": "456", "LOCK_FILE": str(tmp_path / "run.lock")}
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        main()
+
+    # Assert
+    assert mock_stackBy.call_count == 0
+    assert mock_immich_class().modifyAssets.call_count == 0
+
+
+@pytest.mark.parametrize(
+    "seconds,page_bytes,next_offset,expected_size",
+    [
+        (0.1, 1000, 1000, 1000),  # fast page, aligned offset: grow
+        (0.1, 1000, 1500, 500),  # fast page, offset not aligned: wait
+        (1.5, 1000, 1000, 500),  # within target: keep
+        (5.0, 1000, 1000, 250),  # slow page: shrink
+        (0.1, 60 * 1024 * 1024, 1000, 250),  # heavy page: shrink
+    ],
+)
+def test_PageSizer_adapts_to_latency_and_payload_size(seconds, page_bytes, next_offset, expected_size):
+    # Arrange
+    sizer = PageSizer(500, adaptive=True, target_seconds=2.0)
+
+    # Act
+    sizer.observe(seconds, page_bytes, next_offset)
+
+    # Assert
+    assert sizer.size == expected_size
+
+
+@pytest.mark.parametrize(
+    "size,adaptive,seconds,expected_size",
+    [
+        (1000, True, 0.1, 1000),
+        (250, True, 5.0, 250),
+        (500, False, 0.1, 500),
+    ],
+)
+def test_PageSizer_stays_within_bounds_or_fixed(size, adaptive, seconds, expected_size):
+    # Arrange
+    sizer = PageSizer(size, adaptive=adaptive, minimum=250)
+
+    # Act
+    sizer.observe(seconds, 1000, 0)
+
+    # Assert
+    assert sizer.size == expected_size
+
+
+def test_PageSizer_caps_sizes_at_the_server_limit():
+    # Arrange
+    test_environ = {"PAGE_SIZE_ADAPTIVE": "True", "PAGE_SIZE_MAX": "8000"}
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        sizer = PageSizer.fromEnvironment(2000)
+    sizer.observe(0.1, 1000, 2000)
+
+    # Assert
+    assert sizer.size == 1000
+    assert sizer.maximum == 1000
+
+
+@patch("immich_auto_stack.time.sleep")
+@patch("immich_auto_stack.Session")
+def test_fetchAssets_keeps_pages_aligned_when_page_size_changes(mock_session_class, mock_sleep):
+    # Arrange
+    library = [{"id": str(i)} for i in range(37)]
+    requested = []
+
+    def post(url, headers, json):
+        requested.append((json["page"], json["size"]))
+        start = (json["page"] - 1) * json["size"]
+        items = library[start : start + json["size"]]
+        response = Mock()
+        response.ok = True
+        response.content = b"{}"
+        next_page = json["page"] + 1 if start + json["size"] < len(library) else None
+        response.json.return_value = {"assets": {"items": items, "nextPage": next_page}}
+        return response
+
+    mock_session_class().post.side_effect = post
+    immich = Immich("http://immich", "key")
+    test_environ = {"PAGE_SIZE_ADAPTIVE": "True", "PAGE_SIZE_MIN": "2", "PAGE_SIZE_MAX": "16"}
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        result = immich.fetchAssets(size=2)
+
+    # Assert
+    assert ids(result) == [x["id"] for x in library]
+    assert len({size for _, size in requested}) > 1
+    assert immich.metrics["page_size_max"] == 16
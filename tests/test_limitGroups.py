@@ -0,0 +1,77 @@
+import os
+import pytest
+from unittest.mock import patch
+
+from immich_auto_stack import group_size_histogram, limitGroups, plan_stack
+
+
+def stack_factory(size, file_base="IMG_1234"):
+    return [
+        {"id": f"{file_base}-{i}", "originalFileName": f"{file_base}_{i:04d}.raw", "stackCount": None}
+        for i in range(size)
+    ]
+
+
+def test_group_size_histogram_uses_power_of_two_buckets():
+    # Arrange
+    groups = [("key", stack_factory(size)) for size in [2, 2, 3, 4, 5, 8, 9, 1000]]
+
+    # Act
+    result = group_size_histogram(groups)
+
+    # Assert
+    assert result == {"2": 2, "3-4": 2, "5-8": 2, "9-16": 1, "513-1024": 1}
+
+
+@pytest.mark.parametrize(
+    "action,expected_sizes",
+    [
+        ("warn", [3, 12]),
+        ("skip", [3]),
+        ("split", [3, 5, 5, 2]),
+    ],
+)
+def test_limitGroups_applies_action_to_oversized_groups(action, expected_sizes):
+    # Arrange
+    groups = [("small", stack_factory(3)), ("large", stack_factory(12))]
+
+    # Act
+    result = list(limitGroups(groups, max_size=5, action=action))
+
+    # Assert
+    assert [len(stack) for _, stack in result] == expected_sizes
+
+
+def test_limitGroups_split_keeps_the_preferred_parent_first():
+    # Arrange
+    stack = stack_factory(6)
+    stack[4]["originalFileName"] = "IMG_1234_0004.jpg"
+
+    # Act
+    result = list(limitGroups([("key", stack)], max_size=3, action="split"))
+
+    # Assert
+    assert result[0][1][0]["originalFileName"] == "IMG_1234_0004.jpg"
+
+
+@pytest.mark.parametrize(
+    "size,chunk_size,expected_payloads",
+    [
+        (2, "500", 1),
+        (501, "500", 1),
+        (502, "500", 2),
+        (11, "3", 4),
+    ],
+)
+def test_plan_stack_chunks_large_mutations(size, chunk_size, expected_payloads):
+    # Arrange
+    stack = stack_factory(size)
+
+    # Act
+    with patch.dict(os.environ, {"MUTATION_CHUNK_SIZE": chunk_size}):
+        result = plan_stack(0, 1, "key", stack, skip_previous=True)
+
+    # Assert
+    assert len(result) == expected_payloads
+    assert [i for payload in result for i in payload["ids"]] == [x["id"] for x in stack[1:]]
+    assert {payload["stackParentId"] for payload in result} == {stack[0]["id"]}
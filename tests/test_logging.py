@@ -0,0 +1,81 @@
+import logging
+import os
+import pytest
+from unittest.mock import patch
+
+from immich_auto_stack import Progress, log_detail, logger, queued_logging
+
+
+@pytest.mark.parametrize(
+    "log_summary,expected_in_stdout",
+    [
+        ("False", True),
+        ("True", False),
+    ],
+)
+def test_queued_logging_keeps_detail_out_of_stdout_in_summary_mode(
+    capsys, log_summary, expected_in_stdout
+):
+    # Arrange
+    test_environ = {"LOG_SUMMARY": log_summary}
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        with queued_logging():
+            log_detail("detail line")
+            logger.info("summary line")
+
+    # Assert
+    stdout = capsys.readouterr().out
+    assert "summary line" in stdout
+    assert ("detail line" in stdout) == expected_in_stdout
+
+
+def test_queued_logging_writes_detail_to_report_file(tmp_path):
+    # Arrange
+    report_file = tmp_path / "report.log"
+    test_environ = {"LOG_SUMMARY": "True", "REPORT_FILE": str(report_file)}
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        with queued_logging():
+            log_detail("detail line")
+            logger.info("summary line")
+
+    # Assert
+    report = report_file.read_text()
+    assert "detail line" in report
+    assert "summary line" not in report
+
+
+def test_queued_logging_restores_previous_handlers():
+    # Arrange
+    root = logging.getLogger()
+    previous_handlers = root.handlers[:]
+
+    # Act
+    with queued_logging():
+        assert root.handlers != previous_handlers
+
+    # Assert
+    assert root.handlers == previous_handlers
+
+
+@patch("immich_auto_stack.logger")
+def test_progress_reports_rate_and_eta_at_most_once_per_interval(mock_logger):
+    # Arrange
+    progress = Progress(total=100, interval=3600)
+
+    # Act
+    for _ in range(99):
+        progress.step()
+    calls_before_last = mock_logger.info.call_count
+    progress.step()
+
+    # Assert
+    assert calls_before_last == 0
+    assert mock_logger.info.call_count == 1
+    message = mock_logger.info.call_args[0][0]
+    assert "100/100 stacks" in message
+    assert "stacks/s" in message
+    assert "ETA" in message
@@ -0,0 +1,154 @@
+import logging
+import os
+import pytest
+from unittest.mock import Mock, patch
+
+from immich_auto_stack import Immich, get_criteria_sets, main, preflight
+
+regex_criteria = r'[{"key": "originalFileName", "regex": {"key": "(IMG_[0-9]{4})"}}, {"key": "localDateTime"}]'
+
+
+def asset_factory(asset_id, filename, date_time="2024-05-01T10:00:00.000Z"):
+    return {"id": asset_id, "originalFileName": filename, "localDateTime": date_time}
+
+
+def library_factory(count):
+    return [
+        asset_factory(f"{i}-{ext}", f"IMG_{i:04d}.{ext}", f"2024-05-01T10:{i % 60:02d}:00.000Z")
+        for i in range(count)
+        for ext in ("jpg", "CR2")
+    ]
+
+
+def criteria_sets(criteria):
+    with patch.dict(os.environ, {"CRITERIA": criteria}):
+        return get_criteria_sets()
+
+
+def test_preflight_accepts_sane_criteria(caplog):
+    # Arrange
+    sample = library_factory(20)
+    caplog.set_level(logging.INFO)
+
+    # Act
+    problems = preflight(sample, criteria_sets(regex_criteria))
+
+    # Assert
+    assert problems == []
+    assert "100% match, 20 distinct keys, 20 groups" in caplog.text
+
+
+def test_preflight_rejects_misses_that_would_fail_the_run():
+    # Arrange
+    sample = library_factory(5) + [asset_factory("dsc", "DSC_0001.jpg")]
+
+    # Act
+    problems = preflight(sample, criteria_sets(regex_criteria))
+
+    # Assert
+    assert len(problems) == 1
+    assert "DSC_0001.jpg" in problems[0]
+
+
+@pytest.mark.parametrize(
+    "min_match,expected_problems",
+    [
+        ("0", 0),
+        ("0.5", 1),
+    ],
+)
+def test_preflight_rejects_a_low_match_rate_with_SKIP_MATCH_MISS(min_match, expected_problems):
+    # Arrange
+    sample = library_factory(2) + [asset_factory(f"dsc-{i}", f"DSC_{i:04d}.jpg") for i in range(6)]
+
+    # Act
+    with patch.dict(os.environ, {"SKIP_MATCH_MISS": "true"}):
+        problems = preflight(sample, criteria_sets(regex_criteria), float(min_match))
+
+    # Assert
+    assert len(problems) == expected_problems
+
+
+def test_preflight_rejects_criteria_that_match_nothing():
+    # Arrange
+    sample = [asset_factory(f"dsc-{i}", f"DSC_{i:04d}.jpg") for i in range(6)]
+
+    # Act
+    with patch.dict(os.environ, {"SKIP_MATCH_MISS": "true"}):
+        problems = preflight(sample, criteria_sets(regex_criteria))
+
+    # Assert
+    assert problems == ['Only 0.0% of the sampled assets match "default"']
+
+
+def test_preflight_rejects_criteria_that_put_everything_in_one_stack():
+    # Arrange
+    sample = library_factory(10)
+
+    # Act
+    problems = preflight(sample, criteria_sets('[{"key": "originalFileName", "split": {"key": "_", "index": 0}}]'))
+
+    # Assert
+    assert len(problems) == 1
+    assert "share the key ('IMG',)" in problems[0]
+
+
+@pytest.mark.parametrize(
+    "random,endpoint,response_data",
+    [
+        (False, "/search/metadata", {"assets": {"items": [{"id": "a"}], "nextPage": None}}),
+        (True, "/search/random", [{"id": "a"}]),
+    ],
+)
+@patch("immich_auto_stack.Session")
+def test_fetchSample_fetches_a_single_page(mock_session_class, random, endpoint, response_data):
+    # Arrange
+    response = Mock(ok=True, status_code=200, content=b"{}")
+    response.json.return_value = response_data
+    mock_session_class().post.return_value = response
+    immich = Immich("http://immich", "key")
+
+    # Act
+    result = immich.fetchSample(50, random)
+
+    # Assert
+    assert result == [{"id": "a"}]
+    assert mock_session_class().post.call_count == 1
+    assert mock_session_class().post.call_args[0][0] == f"http://immich/api{endpoint}"
+    assert mock_session_class().post.call_args[1]["json"]["size"] == 50
+
+
+@patch("immich_auto_stack.Session")
+def test_fetchSample_caps_the_size_at_the_server_limit(mock_session_class):
+    # Arrange
+    response = Mock(ok=True, status_code=200, content=b"{}")
+    response.json.return_value = [{"id": "a"}]
+    mock_session_class().post.return_value = response
+    immich = Immich("http://immich", "key")
+
+    # Act
+    immich.fetchSample(5000, True)
+
+    # Assert
+    assert mock_session_class().post.call_args[1]["json"]["size"] == 1000
+
+
+@patch("immich_auto_stack.Immich")
+def test_main_stops_before_the_full_fetch_on_broken_criteria(mock_immich_class, tmp_path):
+    # Arrange
+    mock_immich_class().fetchSample.return_value = [asset_factory("dsc", "DSC_0001.jpg")]
+    test_environ = {
+        "API_KEY": "123",
+        "API_URL": "http://immich",
+        "CRITERIA": regex_criteria,
+        "PREFLIGHT": "100",
+        "LOCK_FILE": str(tmp_path / "lock"),
+    }
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        main()
+
+    # Assert
+    mock_immich_class().fetchSample.assert_called_once_with(100, False)
+    mock_immich_class().fetchAssets.assert_not_called()
@@ -0,0 +1,140 @@
+import os
+from unittest.mock import Mock, patch
+
+from immich_auto_stack import Immich, refineWithExif, stratifyStack
+
+
+def asset_factory(asset_id, filename="IMG_1234.jpg", stack_count=None):
+    return {"id": asset_id, "originalFileName": filename, "stackCount": stack_count}
+
+
+def test_refineWithExif_fetches_exif_only_for_candidate_assets():
+    # Arrange
+    groups = [(["IMG_1234"], [asset_factory("a"), asset_factory("b")])]
+    immich = Mock()
+    immich.fetchExif.return_value = {"a": {"model": "X-T3"}, "b": {"model": "X-T3"}}
+
+    # Act
+    result = refineWithExif(immich, groups, [])
+
+    # Assert
+    assert immich.fetchExif.call_args.args[0] == ["a", "b"]
+    assert result == [
+        (
+            ["IMG_1234"],
+            [
+                {**asset_factory("a"), "exifInfo": {"model": "X-T3"}},
+                {**asset_factory("b"), "exifInfo": {"model": "X-T3"}},
+            ],
+        )
+    ]
+
+
+def test_refineWithExif_splits_groups_by_exif_criteria():
+    # Arrange
+    groups = [(["IMG_1234"], [asset_factory(i) for i in "abcde"])]
+    immich = Mock()
+    immich.fetchExif.return_value = {
+        "a": {"model": "X-T3"},
+        "b": {"model": "EOS R"},
+        "c": {"model": "X-T3"},
+        "d": {"model": "EOS R"},
+        "e": {"model": "iPhone"},
+    }
+
+    # Act
+    result = refineWithExif(immich, groups, [{"key": "model"}])
+
+    # Assert
+    assert [(key, [x["id"] for x in stack]) for key, stack in result] == [
+        (["IMG_1234", "EOS R"], ["b", "d"]),
+        (["IMG_1234", "X-T3"], ["a", "c"]),
+    ]
+
+
+def test_refineWithExif_holds_back_groups_with_a_failed_fetch():
+    # Arrange
+    groups = [
+        (["IMG_1"], [asset_factory("a"), asset_factory("b")]),
+        (["IMG_2"], [asset_factory("c"), asset_factory("d")]),
+    ]
+    immich = Mock()
+    immich.fetchExif.return_value = {"a": {"model": "X-T3"}, "c": {"model": "X-T3"}, "d": {"model": "X-T3"}}
+
+    # Act
+    with patch.dict(os.environ, {"SKIP_MATCH_MISS": "false"}):
+        result = refineWithExif(immich, groups, [{"key": "model"}])
+
+    # Assert
+    assert [(key, [x["id"] for x in stack]) for key, stack in result] == [(["IMG_2", "X-T3"], ["c", "d"])]
+
+
+def test_refineWithExif_leaves_out_assets_missing_a_criteria_field():
+    # Arrange
+    groups = [(["IMG_1"], [asset_factory(i) for i in "abc"])]
+    immich = Mock()
+    immich.fetchExif.return_value = {
+        "a": {"lensModel": "XF35mm"},
+        "b": {"lensModel": "XF35mm"},
+        "c": {"lensModel": None},
+    }
+
+    # Act
+    with patch.dict(os.environ, {"SKIP_MATCH_MISS": "false"}):
+        result = refineWithExif(immich, groups, [{"key": "lensModel"}])
+
+    # Assert
+    assert [(key, [x["id"] for x in stack]) for key, stack in result] == [(["IMG_1", "XF35mm"], ["a", "b"])]
+
+
+def test_refineWithExif_skips_fully_stacked_groups_with_skip_previous():
+    # Arrange
+    stacked = (["IMG_1"], [asset_factory("a", stack_count=2), asset_factory("b", stack_count=2)])
+    new = (["IMG_2"], [asset_factory("c", stack_count=2), asset_factory("d")])
+    immich = Mock()
+    immich.fetchExif.return_value = {"c": {"model": "X-T3"}, "d": {"model": "X-T3"}}
+
+    # Act
+    result = refineWithExif(immich, [stacked, new], [{"key": "model"}], skip_previous=True)
+
+    # Assert
+    assert immich.fetchExif.call_args.args[0] == ["c", "d"]
+    assert [key for key, _ in result] == [["IMG_1"], ["IMG_2", "X-T3"]]
+
+
+def test_parent_criteria_prefers_largest_exif_value():
+    # Arrange
+    stack = [
+        {"id": "small", "originalFileName": "IMG_1234_small.jpg", "exifInfo": {"exifImageWidth": 1024}},
+        {"id": "raw", "originalFileName": "IMG_1234.raw", "exifInfo": {"exifImageWidth": 8000}},
+        {"id": "large", "originalFileName": "IMG_1234_large.jpg", "exifInfo": {"exifImageWidth": 6000}},
+        {"id": "none", "originalFileName": "IMG_1234.jpg", "exifInfo": None},
+    ]
+
+    # Act
+    with patch.dict(os.environ, {"PARENT_EXIF_PREFER": "exifImageWidth"}):
+        result = stratifyStack(stack)
+
+    # Assert
+    assert [x["id"] for x in result] == ["large", "small", "none", "raw"]
+
+
+@patch("immich_auto_stack.Session")
+def test_fetchExif_requests_each_asset_and_skips_failures(mock_session_class):
+    # Arrange
+    def get(url, headers):
+        response = Mock()
+        asset_id = url.rsplit("/", 1)[1]
+        response.ok = asset_id != "broken"
+        response.status_code = 200 if response.ok else 500
+        response.json.return_value = {"id": asset_id, "exifInfo": {"make": asset_id}}
+        return response
+
+    mock_session_class().get.side_effect = get
+    immich = Immich("http://immich", "key")
+
+    # Act
+    result = immich.fetchExif(["a", "broken", "c"], workers=2, batch_size=2)
+
+    # Assert
+    assert result == {"a": {"make": "a"}, "c": {"make": "c"}}
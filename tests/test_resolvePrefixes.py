@@ -0,0 +1,108 @@
+import json
+import os
+import pytest
+from unittest.mock import patch
+
+from immich_auto_stack import apply_criteria, resolvePrefixes, stackBy
+
+
+def asset_factory(asset_id, filename, date_time="2024-05-01T10:00:00.000Z"):
+    return {"id": asset_id, "originalFileName": filename, "localDateTime": date_time}
+
+
+def group(assets, criteria):
+    config = json.loads(criteria)
+    with patch.dict(os.environ, {"CRITERIA": criteria}):
+        resolvePrefixes(assets, config)
+        return sorted(sorted(x["id"] for x in stack) for _, stack in stackBy(assets, apply_criteria))
+
+
+prefix_and_time = '[{"key": "originalFileName", "prefix": {}}, {"key": "localDateTime"}]'
+
+
+def test_resolvePrefixes_groups_derivatives_with_their_original():
+    # Arrange
+    assets = [
+        asset_factory("raw", "IMG_1234.CR2"),
+        asset_factory("jpg", "IMG_1234.JPG"),
+        asset_factory("edit", "IMG_1234-edit.jpg"),
+        asset_factory("hdr", "IMG_1234_HDR.tif"),
+        asset_factory("hdr_edit", "IMG_1234_HDR-Edit.jpg"),
+        asset_factory("copy", "img_1234 (1).jpg"),
+        asset_factory("other", "IMG_12345.jpg"),
+    ]
+
+    # Act
+    result = group(assets, prefix_and_time)
+
+    # Assert
+    assert result == [["copy", "edit", "hdr", "hdr_edit", "jpg", "raw"]]
+
+
+@pytest.mark.parametrize(
+    "file_list",
+    [
+        # Derivatives of an original that is not in the library
+        ["IMG_1234-edit.jpg", "IMG_1234_HDR.tif"],
+        # Not at a boundary
+        ["IMG_1234.jpg", "IMG_12340.jpg", "IMG_1234a.jpg"],
+    ],
+)
+def test_resolvePrefixes_keeps_unrelated_names_apart(file_list):
+    # Arrange
+    assets = [asset_factory(str(i), filename) for i, filename in enumerate(file_list)]
+
+    # Act
+    result = group(assets, prefix_and_time)
+
+    # Assert
+    assert result == []
+
+
+def test_resolvePrefixes_only_matches_within_the_other_criteria():
+    # Arrange
+    assets = [
+        asset_factory("original", "IMG_1234.CR2", "2024-05-01T10:00:00.000Z"),
+        asset_factory("same_time", "IMG_1234-edit.jpg", "2024-05-01T10:00:00.000Z"),
+        asset_factory("other_time", "IMG_1234-edit2.jpg", "2024-05-01T11:00:00.000Z"),
+    ]
+
+    # Act
+    result = group(assets, prefix_and_time)
+
+    # Assert
+    assert result == [["original", "same_time"]]
+
+
+def test_resolvePrefixes_window_matches_nearby_times_and_splits_counter_wraparound():
+    # Arrange
+    criteria = '[{"key": "originalFileName", "prefix": {"window": 3600}}]'
+    assets = [
+        asset_factory("2020", "IMG_0001.CR2", "2020-01-01T10:00:00.000Z"),
+        asset_factory("2020_edit", "IMG_0001-edit.jpg", "2020-01-01T10:30:00.000Z"),
+        asset_factory("2024", "IMG_0001.CR2", "2024-01-01T10:00:00.000Z"),
+        asset_factory("2024_jpg", "IMG_0001.JPG", "2024-01-01T10:00:01.000Z"),
+        asset_factory("late_edit", "IMG_0001-edit.jpg", "2024-03-01T10:00:00.000Z"),
+    ]
+
+    # Act
+    result = group(assets, criteria)
+
+    # Assert
+    assert result == [["2020", "2020_edit"], ["2024", "2024_jpg"]]
+
+
+def test_resolvePrefixes_honors_a_custom_boundary():
+    # Arrange
+    criteria = '[{"key": "originalFileName", "prefix": {"boundary": "-"}}, {"key": "localDateTime"}]'
+    assets = [
+        asset_factory("original", "DSCF2700.RAF"),
+        asset_factory("dash", "DSCF2700-edit.jpg"),
+        asset_factory("underscore", "DSCF2700_edit.jpg"),
+    ]
+
+    # Act
+    result = group(assets, criteria)
+
+    # Assert
+    assert result == [["dash", "original"]]
@@ -0,0 +1,139 @@
+from faker import Faker
+import os
+import pytest
+from unittest.mock import patch
+
+from immich_auto_stack import (
+    apply_criteria,
+    auditStacks,
+    loadSnapshot,
+    main,
+    saveSnapshot,
+    stackBy,
+    stratifyStack,
+)
+
+fake = Faker()
+
+
+def asset_factory(file_base=None, date_time=None, extension="jpg", **kwargs):
+    return {
+        "id": fake.uuid4(),
+        "originalFileName": (file_base or fake.unique.file_name(extension="")) + "." + extension,
+        "localDateTime": date_time or fake.iso8601(),
+        "stackCount": None,
+        "isFavorite": fake.boolean(),
+        "exifInfo": {"make": "Canon"},
+        **kwargs,
+    }
+
+
+def library_factory(size=60):
+    assets = []
+    for _ in range(size):
+        date_time = fake.iso8601()
+        file_base = fake.unique.file_name(extension="")
+        for extension in ["jpg", "cr2", "xmp"][: fake.random_int(1, 3)]:
+            assets.append(
+                asset_factory(file_base=file_base, extension=extension, date_time=date_time)
+            )
+    return assets
+
+
+def test_snapshot_round_trips_scalar_fields(tmp_path):
+    # Arrange
+    path = str(tmp_path / "library.snapshot")
+    assets = [
+        asset_factory(stackCount=3, duration=1.5),
+        asset_factory(thumbhash=None),
+        {"id": "only-id"},
+    ]
+    expected_result = [
+        {k: v for k, v in asset.items() if k != "exifInfo"} for asset in assets
+    ]
+
+    # Act
+    saveSnapshot(assets, path)
+    result = loadSnapshot(path)
+
+    # Assert
+    assert result == expected_result
+
+
+def test_snapshot_loads_only_requested_fields(tmp_path):
+    # Arrange
+    path = str(tmp_path / "library.snapshot")
+    assets = [asset_factory() for _ in range(3)]
+
+    # Act
+    saveSnapshot(assets, path)
+    result = loadSnapshot(path, fields=["id"])
+
+    # Assert
+    assert result == [{"id": asset["id"]} for asset in assets]
+
+
+def test_snapshot_rejects_foreign_files(tmp_path):
+    # Arrange
+    path = tmp_path / "library.snapshot"
+    path.write_bytes(b'[{"id": "not a snapshot"}]')
+
+    # Act
+    # Assert
+    with pytest.raises(Exception) as execinfo:
+        loadSnapshot(str(path))
+    assert "not an immich-auto-stack snapshot" in str(execinfo.value)
+
+
+def test_snapshot_groups_identically_to_live_assets(tmp_path):
+    # Arrange
+    path = str(tmp_path / "library.snapshot")
+    assets = library_factory()
+    expected_result = [
+        (key, [asset["id"] for asset in stratifyStack(stack)])
+        for key, stack in stackBy(assets, apply_criteria)
+    ]
+
+    # Act
+    saveSnapshot(assets, path)
+    result = [
+        (key, [asset["id"] for asset in stratifyStack(stack)])
+        for key, stack in stackBy(loadSnapshot(path), apply_criteria)
+    ]
+
+    # Assert
+    assert result == expected_result
+
+
+def test_snapshot_keeps_the_stack_primary_asset_for_audits(tmp_path):
+    # Arrange
+    path = str(tmp_path / "library.snapshot")
+    jpg = asset_factory(file_base="IMG_1", stack={"primaryAssetId": "jpg", "assetCount": 2}, id="jpg")
+    other = asset_factory(file_base="IMG_2", stack={"primaryAssetId": "jpg", "assetCount": 2}, id="other")
+    assets = [jpg, other, asset_factory(file_base="IMG_3", id="loose")]
+
+    # Act
+    saveSnapshot(assets, path)
+    result = loadSnapshot(path)
+    mismatches, _, _ = auditStacks(result, [])
+
+    # Assert
+    assert [x.get("stack") for x in result] == [{"primaryAssetId": "jpg"}, {"primaryAssetId": "jpg"}, None]
+    assert mismatches and mismatches == auditStacks(assets, [])[0]
+    assert loadSnapshot(path, fields=["id"]) == [{"id": "jpg"}, {"id": "other"}, {"id": "loose"}]
+
+
+@patch("immich_auto_stack.Immich")
+def test_main_runs_offline_from_snapshot_without_mutating(mock_immich_class, tmp_path):
+    # Arrange
+    path = str(tmp_path / "library.snapshot")
+    saveSnapshot(library_factory(), path)
+    test_environ = {"SNAPSHOT_LOAD": path, "DRY_RUN": "False", "LOCK_FILE": str(tmp_path / "run.lock")}
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        os.environ.pop("API_KEY", None)
+        main()
+
+    # Assert
+    assert mock_immich_class.call_count == 0
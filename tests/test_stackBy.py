@@ -158,3 +158,161 @@ def test_stackBy_will_not_process_photos_with_empty_key(
             assert result == [
                 ([date_time], [file_1, file_4]),
             ]
+
+
+@pytest.mark.parametrize(
+    "memory_budget",
+    [
+        "0.0001",
+        "0.001",
+        "100",
+    ],
+)
+def test_stackBy_spilling_to_disk_matches_in_memory_grouping(memory_budget):
+    # Arrange
+    assets = []
+    for _ in range(50):
+        date_time = fake.date_time()
+        file_base = fake.unique.file_name(extension="")
+        for extension in ["jpg", "raw", "xmp"][: fake.random_int(1, 3)]:
+            assets.append(
+                asset_factory(file_base=file_base, extension=extension, date_time=date_time)
+            )
+    fake.random.shuffle(assets)
+    expected_result = stackBy(data=assets, criteria=mock_criteria)
+
+    # Act
+    with patch.dict(os.environ, {"MEMORY_BUDGET": memory_budget}):
+        result = stackBy(data=assets, criteria=mock_criteria)
+
+    # Assert
+    assert result == expected_result
+
+
+@pytest.mark.parametrize(
+    "is_skip_match_miss",
+    [
+        True,
+        False,
+    ],
+)
+def test_stackBy_spilling_to_disk_handles_empty_keys(is_skip_match_miss):
+    # Arrange
+    date_time = fake.date_time()
+    file_1 = asset_factory(file_base="test_filename", date_time=date_time)
+    file_2 = asset_factory(file_base="test_filename", date_time=date_time)
+    file_3 = asset_factory(file_base="test_filename", date_time=date_time)
+    file_4 = asset_factory(file_base="test_filename", date_time=date_time)
+    file_2["localDateTime"] = None
+    file_3["localDateTime"] = None
+    input_kwargs = {
+        "data": [file_1, file_2, file_3, file_4],
+        "criteria": mock_empty_criteria,
+    }
+    test_environ = {
+        "SKIP_MATCH_MISS": str(is_skip_match_miss),
+        "MEMORY_BUDGET": "0.0001",
+    }
+
+    # Act
+    # Assert
+    with patch.dict(os.environ, test_environ):
+        if not is_skip_match_miss:
+            with pytest.raises(Exception) as execinfo:
+                stackBy(**input_kwargs)
+            assert "Some photos do not match the criteria" in str(execinfo.value)
+        else:
+            result = stackBy(**input_kwargs)
+            assert result == [
+                ([date_time], [file_1, file_4]),
+            ]
+
+
+def test_stackBy_spilling_to_disk_returns_the_original_assets_without_copies():
+    # Arrange
+    import tracemalloc
+    date_time = fake.date_time()
+    assets = []
+    for i in range(4000):
+        for extension in ["jpg", "raw"]:
+            asset = asset_factory(file_base=f"IMG_{i:05d}", extension=extension, date_time=date_time)
+            asset.update({f"field_{n}": f"value {n} of asset {i}" for n in range(40)})
+            assets.append(asset)
+
+    def peak(environ):
+        tracemalloc.start()
+        with patch.dict(os.environ, environ):
+            result = stackBy(data=assets, criteria=mock_criteria)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, peak
+
+    in_memory, in_memory_peak = peak({})
+
+    # Act
+    result, spilled_peak = peak({"MEMORY_BUDGET": "0.05"})
+
+    # Assert
+    assert result == in_memory
+    assert all(x is y for (_, a), (_, b) in zip(result, in_memory) for x, y in zip(a, b))
+    assert spilled_peak < 2 * in_memory_peak
+
+
+def test_stackBy_merges_many_spilled_runs_with_a_bounded_fan_in():
+    # Arrange
+    import immich_auto_stack
+
+    date_time = fake.date_time()
+    assets = [
+        asset_factory(file_base=f"IMG_{i % 10:04d}", extension=f"{i}", date_time=date_time)
+        for i in range(100)
+    ]
+    expected_result = stackBy(data=assets, criteria=mock_criteria)
+    read_run = immich_auto_stack._read_run
+    open_runs = 0
+    max_open_runs = 0
+
+    def tracked_read_run(path):
+        nonlocal open_runs, max_open_runs
+        open_runs += 1
+        max_open_runs = max(max_open_runs, open_runs)
+        try:
+            yield from read_run(path)
+        finally:
+            open_runs -= 1
+
+    # Act
+    with patch.dict(os.environ, {"MEMORY_BUDGET": "0.0001"}), patch(
+        "immich_auto_stack._read_run", side_effect=tracked_read_run
+    ), patch("immich_auto_stack.merge_fan_in", 4):
+        result = stackBy(data=assets, criteria=mock_criteria)
+
+    # Assert
+    assert result == expected_result
+    assert max_open_runs == 4
+
+
+@pytest.mark.parametrize("memory_budget", ["", "0.0001"])
+def test_stackBy_rejects_groups_whose_key_contains_None(memory_budget):
+    # Arrange
+    def optional_prefix_criteria(x):
+        # Like a regex with an optional group: None for files without the prefix
+        prefix = "IMG" if x["originalFileName"].startswith("IMG") else None
+        return [prefix, x["localDateTime"]]
+
+    date_time = fake.date_time()
+    pair = [
+        asset_factory(file_base="IMG_1", date_time=date_time),
+        asset_factory(file_base="IMG_1", date_time=date_time, extension="cr2"),
+    ]
+    loose = asset_factory(file_base="_1", date_time=fake.date_time())
+
+    # Act
+    with patch.dict(os.environ, {"MEMORY_BUDGET": memory_budget}):
+        result = stackBy(pair + [loose], optional_prefix_criteria)
+        with pytest.raises(Exception) as execinfo:
+            stackBy(pair + [loose, {**loose, "id": "copy"}], optional_prefix_criteria)
+
+    # Assert
+    assert result == [(["IMG", date_time], pair)]
+    assert "Some photos do not match the criteria" in str(execinfo.value)
@@ -0,0 +1,137 @@
+from faker import Faker
+import os
+import pytest
+from unittest.mock import patch
+
+from immich_auto_stack import apply_criteria, stackBy, stackByColumnar
+
+pytest.importorskip("pandas")
+
+fake = Faker()
+
+regex_criteria = r'[{"key": "originalFileName", "regex": {"key": "([A-Z]+[-_]?[0-9]{4}([-_][0-9]{4})?)([\\._-].*)?\\.[\\w]{3,4}$"}},{"key": "localDateTime"}]'
+
+
+def asset_factory(filename, date_time, **kwargs):
+    return {
+        "id": fake.uuid4(),
+        "originalFileName": filename,
+        "localDateTime": date_time,
+        **kwargs,
+    }
+
+
+def library_factory():
+    assets = []
+    for _ in range(40):
+        date_time = fake.iso8601()
+        number = fake.unique.random_int(1000, 9999)
+        for filename in [
+            f"IMG_{number}.JPG",
+            f"IMG_{number}.CR2",
+            f"IMG_{number}_edit.jpg",
+            f"DSCF{number}-HDR.dng",
+        ][: fake.random_int(1, 4)]:
+            assets.append(asset_factory(filename, date_time, thumbhash=fake.random_element(["a", "b", None])))
+    fake.random.shuffle(assets)
+    return assets
+
+
+def run_both(assets, test_environ):
+    with patch.dict(os.environ, test_environ):
+        expected_result = stackBy(assets, apply_criteria)
+        result = stackByColumnar(assets)
+    return result, expected_result
+
+
+@pytest.mark.parametrize(
+    "criteria",
+    [
+        None,
+        '[{"key": "originalFileName", "split": {"key": "_", "index": 0}}]',
+        '[{"key": "originalFileName", "split": {"key": ".", "index": -1}}, {"key": "localDateTime"}]',
+        '[{"key": "localDateTime", "split": {"key": "T", "index": 0}}]',
+        '[{"key": "thumbhash"}, {"key": "localDateTime"}]',
+        regex_criteria,
+    ],
+)
+def test_stackByColumnar_matches_python_engine(criteria):
+    # Arrange
+    assets = library_factory()
+    test_environ = {"SKIP_MATCH_MISS": "True"}
+    if criteria:
+        test_environ["CRITERIA"] = criteria
+
+    # Act
+    result, expected_result = run_both(assets, test_environ)
+
+    # Assert
+    assert result == expected_result
+
+
+def test_stackByColumnar_raises_the_same_regex_miss_as_python_engine():
+    # Arrange
+    date_time = fake.iso8601()
+    assets = [
+        asset_factory("IMG_1234.jpg", date_time),
+        asset_factory("not a match", date_time),
+        asset_factory("also not a match", date_time),
+    ]
+    test_environ = {"CRITERIA": regex_criteria, "SKIP_MATCH_MISS": "False"}
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        with pytest.raises(Exception) as expected_info:
+            stackBy(assets, apply_criteria)
+        with pytest.raises(Exception) as execinfo:
+            stackByColumnar(assets)
+
+    # Assert
+    assert str(execinfo.value) == str(expected_info.value)
+
+
+@pytest.mark.parametrize(
+    "is_skip_match_miss",
+    [
+        True,
+        False,
+    ],
+)
+def test_stackByColumnar_handles_None_keys_like_python_engine(is_skip_match_miss):
+    # Arrange
+    date_time = fake.iso8601()
+    assets = [
+        asset_factory("IMG_1234.jpg", date_time, thumbhash="foo"),
+        asset_factory("IMG_1234.png", date_time, thumbhash=None),
+        asset_factory("IMG_1234.raw", date_time),
+        asset_factory("IMG_1234.cr2", date_time, thumbhash="foo"),
+    ]
+    test_environ = {
+        "CRITERIA": '[{"key": "thumbhash"}]',
+        "SKIP_MATCH_MISS": str(is_skip_match_miss),
+    }
+
+    # Act
+    # Assert
+    with patch.dict(os.environ, test_environ):
+        if not is_skip_match_miss:
+            with pytest.raises(Exception) as execinfo:
+                stackByColumnar(assets)
+            assert "Some photos do not match the criteria" in str(execinfo.value)
+        else:
+            assert stackByColumnar(assets) == stackBy(assets, apply_criteria)
+
+
+def test_stackByColumnar_falls_back_when_split_index_is_out_of_range():
+    # Arrange
+    assets = [asset_factory("IMG_1234.jpg", fake.iso8601()) for _ in range(2)]
+    test_environ = {
+        "CRITERIA": '[{"key": "originalFileName", "split": {"key": "_", "index": 5}}]',
+    }
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        result = stackByColumnar(assets)
+
+    # Assert
+    assert result is None
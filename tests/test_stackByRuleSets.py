@@ -0,0 +1,111 @@
+import json
+import os
+import pytest
+from unittest.mock import patch
+
+from immich_auto_stack import get_criteria_config, get_criteria_sets, stackByRuleSets
+
+raw_jpg = [
+    {"key": "originalFileName", "split": {"key": ".", "index": 0}},
+    {"key": "localDateTime"},
+]
+burst = [
+    {"key": "localDateTime", "split": {"key": ".", "index": 0}},
+]
+
+
+def asset_factory(asset_id, filename, date_time):
+    return {"id": asset_id, "originalFileName": filename, "localDateTime": date_time}
+
+
+def ids(groups):
+    return [(key, [x["id"] for x in stack]) for key, stack in groups]
+
+
+@pytest.mark.parametrize(
+    "criteria,expected_result",
+    [
+        (None, ["default"]),
+        (json.dumps(raw_jpg), ["default"]),
+        (json.dumps({"raw_jpg": raw_jpg, "burst": burst}), ["raw_jpg", "burst"]),
+        (json.dumps({"burst": burst, "raw_jpg": raw_jpg}), ["burst", "raw_jpg"]),
+    ],
+)
+def test_get_criteria_sets_keeps_definition_order(criteria, expected_result):
+    # Act
+    with patch.dict(os.environ, {}):
+        os.environ.pop("CRITERIA", None)
+        if criteria:
+            os.environ["CRITERIA"] = criteria
+        result = get_criteria_sets()
+        first_config = get_criteria_config()
+
+    # Assert
+    assert [name for name, _ in result] == expected_result
+    assert first_config == result[0][1]
+
+
+@pytest.mark.parametrize(
+    "criteria_sets,expected_result",
+    [
+        (
+            [("raw_jpg", raw_jpg), ("burst", burst)],
+            [
+                (["raw_jpg", "IMG_0001", "2024-01-01T10:00:00.100Z"], ["a", "b"]),
+                (["burst", "2024-01-01T10:00:00"], ["c", "d"]),
+            ],
+        ),
+        (
+            [("burst", burst), ("raw_jpg", raw_jpg)],
+            [
+                (["burst", "2024-01-01T10:00:00"], ["a", "b", "c", "d"]),
+            ],
+        ),
+    ],
+)
+def test_stackByRuleSets_gives_precedence_to_the_first_set(criteria_sets, expected_result):
+    # Arrange
+    assets = [
+        asset_factory("a", "IMG_0001.jpg", "2024-01-01T10:00:00.100Z"),
+        asset_factory("b", "IMG_0001.cr2", "2024-01-01T10:00:00.100Z"),
+        asset_factory("c", "IMG_0002.jpg", "2024-01-01T10:00:00.200Z"),
+        asset_factory("d", "IMG_0003.jpg", "2024-01-01T10:00:00.300Z"),
+        asset_factory("e", "IMG_0004.jpg", "2024-01-02T10:00:00.000Z"),
+    ]
+
+    # Act
+    result = stackByRuleSets(assets, criteria_sets)
+
+    # Assert
+    assert ids(result) == expected_result
+
+
+def test_stackByRuleSets_never_stacks_an_asset_twice():
+    # Arrange
+    assets = [
+        asset_factory(str(i), f"IMG_{i // 2:04d}.{'jpg' if i % 2 else 'cr2'}", f"2024-01-01T10:00:0{i // 4}.000Z")
+        for i in range(16)
+    ]
+
+    # Act
+    result = stackByRuleSets(assets, [("raw_jpg", raw_jpg), ("burst", burst)])
+
+    # Assert
+    stacked_ids = [x["id"] for _, stack in result for x in stack]
+    assert len(stacked_ids) == len(set(stacked_ids))
+
+
+def test_stackByRuleSets_leaves_assets_of_skipped_groups_to_later_sets():
+    # Arrange
+    assets = [
+        asset_factory("a", "IMG_0001.jpg", "2024-01-01T10:00:00.100Z"),
+        asset_factory("b", "IMG_0001.cr2", "2024-01-01T10:00:00.100Z"),
+        asset_factory("c", "IMG_0002.jpg", "2024-01-01T10:00:00.200Z"),
+    ]
+    burst_first = [("burst", burst), ("raw_jpg", raw_jpg)]
+
+    # Act
+    result = stackByRuleSets(assets, burst_first, max_size=2, action="skip")
+
+    # Assert
+    assert ids(result) == [(["raw_jpg", "IMG_0001", "2024-01-01T10:00:00.100Z"], ["a", "b"])]
@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+from faker import Faker
+import os
+import pytest
+from unittest.mock import patch
+
+from immich_auto_stack import (
+    apply_criteria,
+    get_criteria_config,
+    pipeline_supported,
+    runPipeline,
+    stackBy,
+    stackByStream,
+)
+
+fake = Faker()
+
+
+def asset_factory(file_base, created, offset_hours, extension="jpg"):
+    local = created + timedelta(hours=offset_hours)
+    return {
+        "id": fake.uuid4(),
+        "originalFileName": f"{file_base}.{extension}",
+        "fileCreatedAt": created.isoformat() + ".000Z",
+        "localDateTime": local.isoformat() + ".000Z",
+    }
+
+
+def library_factory(size=80):
+    start = datetime(2020, 1, 1)
+    assets = []
+    for _ in range(size):
+        created = start + timedelta(minutes=fake.random_int(0, 60 * 24 * 30))
+        offset_hours = fake.random_int(-12, 14)
+        file_base = fake.unique.file_name(extension="")
+        for extension in ["jpg", "cr2", "xmp"][: fake.random_int(1, 3)]:
+            assets.append(asset_factory(file_base, created, offset_hours, extension))
+    assets.sort(key=lambda x: x["fileCreatedAt"])
+    return assets
+
+
+def paginate(assets, size):
+    return [assets[i : i + size] for i in range(0, len(assets), size)]
+
+
+def normalize(groups):
+    return sorted((key, [x["id"] for x in stack]) for key, stack in groups)
+
+
+@pytest.mark.parametrize("page_size", [1, 7, 1000])
+def test_stackByStream_yields_the_same_groups_as_stackBy(page_size):
+    # Arrange
+    assets = library_factory()
+    expected_result = normalize(stackBy(assets, apply_criteria))
+
+    # Act
+    result = normalize(stackByStream(paginate(assets, page_size), apply_criteria))
+
+    # Assert
+    assert result == expected_result
+
+
+def test_stackByStream_yields_groups_before_the_last_page():
+    # Arrange
+    assets = library_factory()
+    pages = paginate(assets, 5)
+    fetched = []
+
+    def tracked_pages():
+        for page in pages:
+            fetched.append(page)
+            yield page
+
+    # Act
+    stream = stackByStream(tracked_pages(), apply_criteria)
+    next(stream)
+
+    # Assert
+    assert len(fetched) < len(pages)
+
+
+def test_stackByStream_raises_on_empty_keys_without_skip_match_miss():
+    # Arrange
+    assets = library_factory(size=3)
+    for asset in assets[:2]:
+        asset["localDateTime"] = None
+
+    # Act
+    # Assert
+    with patch.dict(os.environ, {"SKIP_MATCH_MISS": "False"}):
+        with pytest.raises(Exception) as execinfo:
+            list(stackByStream([assets], apply_criteria))
+    assert "Some photos do not match the criteria" in str(execinfo.value)
+
+
+@pytest.mark.parametrize(
+    "criteria,expected_result",
+    [
+        ('[{"key": "originalFileName"}, {"key": "localDateTime"}]', True),
+        ('[{"key": "localDateTime", "split": {"key": "T", "index": 0}}]', False),
+        ('[{"key": "originalFileName"}]', False),
+    ],
+)
+def test_pipeline_supported_requires_plain_localDateTime(criteria, expected_result):
+    # Arrange
+    with patch.dict(os.environ, {"CRITERIA": criteria}):
+        config = get_criteria_config()
+
+    # Act
+    result = pipeline_supported(config)
+
+    # Assert
+    assert result == expected_result
+
+
+def test_runPipeline_processes_every_group_and_counts_skips():
+    # Arrange
+    groups = [(["key", i], [{"id": i}, {"id": -i}]) for i in range(50)]
+    handled = []
+
+    def handle(i, key, stack):
+        handled.append(i)
+        return i % 2 == 0
+
+    # Act
+    processed, total = runPipeline(iter(groups), handle)
+
+    # Assert
+    assert total == 50
+    assert processed == 25
+    assert handled == list(range(50))
+
+
+def test_runPipeline_reraises_mutation_errors():
+    # Arrange
+    groups = [(["key", i], [{"id": i}, {"id": -i}]) for i in range(50)]
+
+    def handle(i, key, stack):
+        raise RuntimeError("boom")
+
+    # Act
+    # Assert
+    with pytest.raises(RuntimeError):
+        runPipeline(iter(groups), handle)
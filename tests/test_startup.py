@@ -0,0 +1,177 @@
+import io
+import json
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+
+import immich_auto_stack
+from immich_auto_stack import ChangeDetector
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+heavy_modules = ["requests", "urllib3", "concurrent.futures", "logging.handlers", "pickle", "urllib.request"]
+
+
+def test_import_does_not_load_heavy_modules():
+    # Arrange
+    code = (
+        "import json, sys; import immich_auto_stack; "
+        f"print(json.dumps([m for m in {heavy_modules!r} if m in sys.modules]))"
+    )
+
+    # Act
+    result = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+
+    # Assert
+    assert json.loads(result.stdout) == []
+
+
+def test_http_names_load_on_first_use():
+    # Act
+    session_class = immich_auto_stack.Session
+
+    # Assert
+    from requests import Session
+    assert session_class is Session
+
+
+def response(items):
+    return io.BytesIO(json.dumps({"assets": {"items": items}}).encode())
+
+
+def test_ChangeDetector_without_state_always_runs(tmp_path):
+    # Arrange
+    changes = ChangeDetector(str(tmp_path / "state.json"), "http://immich:2283/api", "key")
+
+    # Act
+    with patch("urllib.request.urlopen") as mock_urlopen:
+        result = changes.unchanged()
+
+    # Assert
+    assert result is False
+    mock_urlopen.assert_not_called()
+
+
+def test_ChangeDetector_skips_when_nothing_was_updated_since_last_run(tmp_path):
+    # Arrange
+    changes = ChangeDetector(str(tmp_path / "state.json"), "http://immich:2283/api", "key")
+    changes.record(1700000000)
+
+    # Act
+    with patch("urllib.request.urlopen", return_value=response([])) as mock_urlopen:
+        result = changes.unchanged()
+
+    # Assert
+    assert result is True
+    request = mock_urlopen.call_args[0][0]
+    assert request.full_url == "http://immich:2283/api/search/metadata"
+    assert json.loads(request.data) == {"size": 1, "updatedAfter": changes.since(), "withStacked": True}
+    assert changes.since() == "2023-11-14T22:08:20+00:00"
+
+
+def test_ChangeDetector_runs_when_an_asset_was_updated(tmp_path):
+    # Arrange
+    changes = ChangeDetector(str(tmp_path / "state.json"), "http://immich:2283/api", "key")
+    changes.record(1700000000)
+
+    # Act
+    with patch("urllib.request.urlopen", return_value=response([{"id": "new"}])):
+        result = changes.unchanged()
+
+    # Assert
+    assert result is False
+
+
+def test_ChangeDetector_runs_when_settings_changed(tmp_path):
+    # Arrange
+    path = str(tmp_path / "state.json")
+    ChangeDetector(path, "http://immich:2283/api", "key").record(1700000000)
+
+    # Act
+    with patch.dict(os.environ, {"CRITERIA": '[{"key": "originalFileName"}]'}):
+        changes = ChangeDetector(path, "http://immich:2283/api", "key")
+
+    # Assert
+    assert changes.since() is None
+
+
+def test_ChangeDetector_runs_when_the_check_fails(tmp_path):
+    # Arrange
+    changes = ChangeDetector(str(tmp_path / "state.json"), "http://immich:2283/api", "key")
+    changes.record(1700000000)
+
+    # Act
+    with patch("urllib.request.urlopen", side_effect=OSError("connection refused")):
+        result = changes.unchanged()
+
+    # Assert
+    assert result is False
+
+
+@patch("immich_auto_stack.Immich")
+def test_main_skips_the_fetch_when_nothing_changed(mock_immich_class, tmp_path):
+    # Arrange
+    test_environ = {
+        "API_KEY": "123",
+        "API_URL": "http://immich:2283/api",
+        "CHANGE_DETECTION": "true",
+        "CHANGE_STATE_FILE": str(tmp_path / "state.json"),
+        "LOCK_FILE": str(tmp_path / "lock"),
+    }
+    with patch.dict(os.environ, test_environ):
+        ChangeDetector(test_environ["CHANGE_STATE_FILE"], test_environ["API_URL"], "123").record(1700000000)
+
+        # Act
+        with patch("urllib.request.urlopen", return_value=response([])):
+            immich_auto_stack.main()
+
+    # Assert
+    mock_immich_class.assert_not_called()
+
+
+@patch("immich_auto_stack.Immich")
+def test_main_records_a_complete_run(mock_immich_class, tmp_path):
+    # Arrange
+    mock_immich_class().fetchAssets.return_value = []
+    test_environ = {
+        "API_KEY": "123",
+        "API_URL": "http://immich:2283/api",
+        "CHANGE_DETECTION": "true",
+        "CHANGE_STATE_FILE": str(tmp_path / "state.json"),
+        "LOCK_FILE": str(tmp_path / "lock"),
+    }
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        immich_auto_stack.main()
+        since = ChangeDetector(test_environ["CHANGE_STATE_FILE"], test_environ["API_URL"], "123").since()
+
+    # Assert
+    assert since is not None
+
+
+@patch("immich_auto_stack.Immich")
+def test_main_does_not_record_a_run_that_held_back_groups(mock_immich_class, tmp_path):
+    # Arrange
+    mock_immich_class().fetchAssets.return_value = [
+        {"id": "jpg", "originalFileName": "IMG_1.jpg", "localDateTime": "2024-05-01T10:00:00.000Z", "stackCount": None},
+        {"id": "raw", "originalFileName": "IMG_1.CR2", "localDateTime": "2024-05-01T10:00:00.000Z", "stackCount": None},
+    ]
+    mock_immich_class().fetchExif.return_value = {}
+    test_environ = {
+        "API_KEY": "123",
+        "API_URL": "http://immich:2283/api",
+        "CHANGE_DETECTION": "true",
+        "CHANGE_STATE_FILE": str(tmp_path / "state.json"),
+        "EXIF_CRITERIA": '[{"key": "model"}]',
+        "LOCK_FILE": str(tmp_path / "lock"),
+    }
+
+    # Act
+    with patch.dict(os.environ, test_environ):
+        immich_auto_stack.main()
+        since = ChangeDetector(test_environ["CHANGE_STATE_FILE"], test_environ["API_URL"], "123").since()
+
+    # Assert
+    assert since is None
+    mock_immich_class().modifyAssets.assert_not_called()